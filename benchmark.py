@@ -0,0 +1,835 @@
+"""
+Benchmarks for the Deal Admin Hub backend
+
+Every benchmark runs against a scratch database (DATABASE_NAME with a
+"_bench" suffix, or BENCH_DATABASE_NAME if set) on the server pointed to by
+DATABASE_URL, so it never touches real data.
+
+Usage:
+    python benchmark.py sync-vs-async --requests 5000 --concurrency 200
+    python benchmark.py snapshot --deals 100000
+    python benchmark.py token-cache
+    python benchmark.py paid-race --invoices 500 --duplicates 8
+    python benchmark.py deal-growth --pairs 50
+    python benchmark.py serve-modes --requests 20000 --concurrency 100
+    python benchmark.py json --iterations 20000
+    python benchmark.py raw-bson --sizes 4096 65536 1048576
+    python benchmark.py polling --clients 200 --rounds 50
+    python benchmark.py sse-idle --subscribers 5000
+    python benchmark.py idempotency --requests 5000
+    python benchmark.py export-rss --invoices 1000000 --max-rss-mib 64
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from uuid import uuid4
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+load_dotenv()
+
+BENCH_DATABASE_NAME = os.getenv("BENCH_DATABASE_NAME") or f"{os.getenv('DATABASE_NAME', 'app')}_bench"
+
+# =============================================================================
+# HELPERS
+# =============================================================================
+
+def bench_db():
+    """Scratch database used by all benchmarks"""
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        sys.exit("DATABASE_URL is not set")
+    return MongoClient(database_url)[BENCH_DATABASE_NAME]
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of a list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+def report(label: str, latencies: list, elapsed: float):
+    """Print throughput and latency percentiles (latencies in seconds)"""
+    rps = len(latencies) / elapsed if elapsed else 0.0
+    print(
+        f"{label:<28} {rps:>9.1f} req/s"
+        f"  p50 {percentile(latencies, 50) * 1000:>7.2f} ms"
+        f"  p99 {percentile(latencies, 99) * 1000:>7.2f} ms"
+    )
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def run_server(command: list, port: int, env: dict = None, label: str = None):
+    """Run a server `command` listening on `port` against the bench database; yields once it accepts connections"""
+    child_env = {**os.environ, "DATABASE_NAME": BENCH_DATABASE_NAME, **(env or {})}
+    proc = subprocess.Popen(command, env=child_env)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"server for {label or command[0]} did not start")
+                time.sleep(0.1)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+@contextmanager
+def serve(app: str, args: tuple = (), env: dict = None):
+    """Run `uvicorn <app>` in a subprocess against the bench database; yields the port"""
+    port = _free_port()
+    command = [sys.executable, "-m", "uvicorn", app, "--port", str(port), "--log-level", "warning", *args]
+    with run_server(command, port, env, label=app):
+        yield port
+
+async def _read_response(reader) -> tuple:
+    """Read one HTTP/1.1 response; returns (status, body, headers)"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    if headers.get("transfer-encoding") == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            body += chunk[:-2]
+        return status, bytes(body), headers
+    return status, await reader.readexactly(int(headers.get("content-length", 0))), headers
+
+async def _http_load(port: int, requests: list, concurrency: int) -> tuple:
+    """Replay (method, path, body[, headers]) requests over keep-alive connections"""
+    queue = iter(requests)
+    latencies = []
+    statuses = {}
+
+    async def worker():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for method, path, body, *headers in queue:
+                body = body or b""
+                extra = "".join(f"{name}: {value}\r\n" for name, value in (headers[0] if headers else {}).items())
+                started = time.perf_counter()
+                writer.write(
+                    f"{method} {path} HTTP/1.1\r\nHost: bench\r\n{extra}"
+                    f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+                status, _, _ = await _read_response(reader)
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, statuses
+
+def http_load(port: int, requests: list, concurrency: int) -> tuple:
+    """Blocking wrapper around _http_load; returns (latencies, elapsed, status counts)"""
+    return asyncio.run(_http_load(port, requests, concurrency))
+
+def seed_mous(count: int) -> list:
+    """Insert `count` MOUs into the bench database and return their sign tokens"""
+    from database import INDEXES
+
+    database = bench_db()
+    database.mou.drop()
+    database.mou.create_indexes(INDEXES["mou"])
+    tokens = [uuid4().hex for _ in range(count)]
+    database.mou.insert_many([
+        {
+            "deal_id": "bench",
+            "my_details": {"name": "Bench Co"},
+            "client_details": {"name": f"Client {i}"},
+            "project": {"name": f"Project {i}"},
+            "terms": {"scope": "x" * 200},
+            "status": "sent",
+            "sign_token": token,
+        }
+        for i, token in enumerate(tokens)
+    ])
+    return tokens
+
+def seed_deals(count: int, batch: int = 10000) -> list:
+    """Seed `count` deals, each with a MOU and an invoice (every other one paid with a receipt).
+
+    Returns the (client_name, project_name) pairs.
+    """
+    from database import INDEXES
+
+    database = bench_db()
+    for name in ("deal", "mou", "invoice", "receipt"):
+        database[name].drop()
+        database[name].create_indexes(INDEXES[name])
+
+    now = datetime.now(timezone.utc)
+    pairs = []
+    for start in range(0, count, batch):
+        deals, mous, invoices, receipts = [], [], [], []
+        for i in range(start, min(start + batch, count)):
+            deal_id = ObjectId()
+            pair = (f"Client {i}", f"Project {i}")
+            pairs.append(pair)
+            paid = i % 2 == 0
+            view_token = uuid4().hex
+            deals.append({"_id": deal_id, "client_name": pair[0], "project_name": pair[1],
+                          "status": "active", "created_at": now, "updated_at": now})
+            mous.append({"deal_id": str(deal_id), "status": "signed", "sign_token": uuid4().hex,
+                         "terms": {"scope": "x" * 200}, "created_at": now, "updated_at": now})
+            invoices.append({"deal_id": str(deal_id), "client_name": pair[0], "project_name": pair[1],
+                             "amount": 1000.0, "currency": "USD", "status": "paid" if paid else "sent",
+                             "view_token": view_token, "created_at": now, "updated_at": now})
+            if paid:
+                receipts.append({"invoice_token": view_token, "deal_id": str(deal_id),
+                                 "created_at": now, "updated_at": now})
+        database.deal.insert_many(deals, ordered=False)
+        database.mou.insert_many(mous, ordered=False)
+        database.invoice.insert_many(invoices, ordered=False)
+        database.receipt.insert_many(receipts, ordered=False)
+    return pairs
+
+# =============================================================================
+# SYNC VS ASYNC ENDPOINTS
+# =============================================================================
+
+def sync_async_app():
+    """App factory exposing the same lookup as a threadpool (def) and an async (async def) endpoint"""
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI, HTTPException
+    import database
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await database.open_async()
+        yield
+        await database.close_async()
+
+    app = FastAPI(lifespan=lifespan)
+
+    @app.get("/sync/mou/{token}")
+    def sync_lookup(token: str):
+        doc = database.get_db().mou.find_one({"sign_token": token})
+        if not doc:
+            raise HTTPException(status_code=404, detail="MOU not found")
+        doc["_id"] = str(doc["_id"])
+        return doc
+
+    @app.get("/async/mou/{token}")
+    async def async_lookup(token: str):
+        doc = await database.async_db.mou.find_one({"sign_token": token})
+        if not doc:
+            raise HTTPException(status_code=404, detail="MOU not found")
+        doc["_id"] = str(doc["_id"])
+        return doc
+
+    return app
+
+def bench_sync_vs_async(args):
+    tokens = seed_mous(1000)
+    with serve("benchmark:sync_async_app", ("--factory",)) as port:
+        for path in ("sync", "async"):
+            requests = [("GET", f"/{path}/mou/{tokens[i % len(tokens)]}", None) for i in range(args.requests)]
+            http_load(port, requests[: args.concurrency], args.concurrency)  # warm-up
+            latencies, elapsed, _ = http_load(port, requests, args.concurrency)
+            report(f"{path} (c={args.concurrency})", latencies, elapsed)
+
+# =============================================================================
+# DEAL SNAPSHOT: FOUR QUERIES VS ONE AGGREGATION
+# =============================================================================
+
+def _snapshot_four_queries(database, client_name: str, project_name: str):
+    """The original deal_snapshot read path, kept here as the baseline"""
+    deal = database.deal.find_one({"client_name": client_name, "project_name": project_name})
+    deal_id = str(deal["_id"])
+    mou = database.mou.find_one({"deal_id": deal_id}, sort=[("created_at", -1)])
+    invoice = database.invoice.find_one({"deal_id": deal_id}, sort=[("created_at", -1)])
+    receipt = None
+    if invoice:
+        receipt = database.receipt.find_one({"invoice_token": invoice.get("view_token")}, sort=[("created_at", -1)])
+    return deal, mou, invoice, receipt
+
+def _snapshot_aggregation(database, client_name: str, project_name: str):
+    from snapshots import snapshot_pipeline, build_snapshot
+
+    pipeline = snapshot_pipeline({"client_name": client_name, "project_name": project_name}, limit=1)
+    return build_snapshot(next(database.deal.aggregate(pipeline)))
+
+def bench_snapshot(args):
+    print(f"Seeding {args.deals} deals ...")
+    pairs = seed_deals(args.deals)
+    database = bench_db()
+    sample = random.Random(42).sample(pairs, min(args.lookups, len(pairs)))
+    for label, read in (("four queries", _snapshot_four_queries), ("one aggregation", _snapshot_aggregation)):
+        for pair in sample[:50]:  # warm-up
+            read(database, *pair)
+        latencies = []
+        started = time.perf_counter()
+        for pair in sample:
+            t0 = time.perf_counter()
+            read(database, *pair)
+            latencies.append(time.perf_counter() - t0)
+        report(label, latencies, time.perf_counter() - started)
+
+# =============================================================================
+# TOKEN DOCUMENT CACHE
+# =============================================================================
+
+def bench_token_cache(args):
+    tokens = seed_mous(args.tokens)
+    rng = random.Random(42)
+    requests = [("GET", f"/api/mou/{rng.choice(tokens)}", None) for _ in range(args.requests)]
+    for label, env in (("uncached", {"TOKEN_CACHE_MAX_BYTES": "0"}), ("cached", {})):
+        with serve("main:app", env=env) as port:
+            http_load(port, requests[: args.concurrency], args.concurrency)  # warm-up
+            latencies, elapsed, _ = http_load(port, requests, args.concurrency)
+            report(label, latencies, elapsed)
+
+# =============================================================================
+# MARK INVOICE PAID UNDER DUPLICATE SUBMITS
+# =============================================================================
+
+def seed_invoices(count: int) -> list:
+    """Seed `count` unpaid invoices (and their deals); returns their view tokens"""
+    from database import INDEXES
+
+    database = bench_db()
+    for name in ("deal", "invoice", "receipt"):
+        database[name].drop()
+        database[name].create_indexes(INDEXES[name])
+
+    now = datetime.now(timezone.utc)
+    deals, invoices, tokens = [], [], []
+    for i in range(count):
+        deal_id = ObjectId()
+        token = uuid4().hex
+        tokens.append(token)
+        deals.append({"_id": deal_id, "client_name": f"Client {i}", "project_name": f"Project {i}",
+                      "status": "active", "created_at": now, "updated_at": now})
+        invoices.append({"deal_id": str(deal_id), "my_details": {"name": "Bench Co"},
+                         "client_name": f"Client {i}", "project_name": f"Project {i}",
+                         "invoice_number": f"INV-{i}", "invoice_date": "2024-01-01", "amount": 1000.0,
+                         "currency": "USD", "bank_details": {}, "payment_reference": f"REF-{i}",
+                         "status": "sent", "view_token": token, "created_at": now, "updated_at": now})
+    database.deal.insert_many(deals, ordered=False)
+    database.invoice.insert_many(invoices, ordered=False)
+    return tokens
+
+def bench_paid_race(args):
+    tokens = seed_invoices(args.invoices)
+    body = json.dumps({"payment_method": "bank", "amount_received": 1000.0, "payment_reference": "x"}).encode()
+    # Duplicates of one invoice are adjacent, so concurrent workers pick them up at the same time
+    requests = [("POST", f"/api/invoice/{token}/paid", body) for token in tokens for _ in range(args.duplicates)]
+    with serve("main:app") as port:
+        latencies, elapsed, statuses = http_load(port, requests, args.concurrency)
+    report(f"paid x{args.duplicates} (c={args.concurrency})", latencies, elapsed)
+
+    database = bench_db()
+    per_invoice = {doc["_id"]: doc["n"] for doc in database.receipt.aggregate(
+        [{"$group": {"_id": "$invoice_token", "n": {"$sum": 1}}}]
+    )}
+    duplicates = sum(1 for n in per_invoice.values() if n > 1)
+    print(f"statuses {statuses}; receipts {sum(per_invoice.values())} for {len(tokens)} invoices; "
+          f"invoices with duplicate receipts: {duplicates}")
+    if duplicates or len(per_invoice) != len(tokens):
+        sys.exit(1)
+
+# =============================================================================
+# DUPLICATE-DEAL GROWTH UNDER CONCURRENT MOU CREATION
+# =============================================================================
+
+def bench_deal_growth(args):
+    from database import INDEXES
+
+    database = bench_db()
+    for name in ("deal", "mou"):
+        database[name].drop()
+        database[name].create_indexes(INDEXES[name])
+
+    def body(i: int) -> bytes:
+        pair = i % args.pairs
+        return json.dumps({
+            "my_details": {"name": "Bench Co"},
+            "client_details": {"name": f"Client {pair}"},
+            "project": {"name": f"Project {pair}"},
+            "terms": {"scope": "x" * 200},
+        }).encode()
+
+    requests = [("POST", "/api/mou", body(i)) for i in range(args.requests)]
+    with serve("main:app") as port:
+        latencies, elapsed, statuses = http_load(port, requests, args.concurrency)
+    report(f"create mou (c={args.concurrency})", latencies, elapsed)
+
+    deals = database.deal.count_documents({})
+    print(f"statuses {statuses}; {deals} deals for {args.pairs} client/project pairs "
+          f"(growth {deals - args.pairs}); {database.mou.count_documents({})} MOUs")
+    if deals != args.pairs:
+        sys.exit(1)
+
+# =============================================================================
+# SERVER MODES: DEV (ONE RELOADING PROCESS) VS PROD (WORKER PER CPU)
+# =============================================================================
+
+def bench_serve_modes(args):
+    from serve import default_workers
+
+    tokens = seed_mous(1000)
+    rng = random.Random(42)
+    workloads = {
+        "healthz": [("GET", "/healthz", None)] * args.requests,
+        "mou lookup": [("GET", f"/api/mou/{rng.choice(tokens)}", None) for _ in range(args.requests)],
+    }
+    workers = args.workers or default_workers()
+    modes = (("dev", ()), (f"prod x{workers}", ("--workers", str(workers), "--log-level", "warning")))
+    for label, extra in modes:
+        port = _free_port()
+        command = [sys.executable, "serve.py", label.split()[0], "--host", "127.0.0.1", "--port", str(port), *extra]
+        # Cache off so every lookup reaches MongoDB
+        with run_server(command, port, env={"TOKEN_CACHE_MAX_BYTES": "0"}, label=label):
+            for name, requests in workloads.items():
+                http_load(port, requests[: args.concurrency * 4], args.concurrency)  # warm-up, reaches every worker
+                latencies, elapsed, _ = http_load(port, requests, args.concurrency)
+                report(f"{label}: {name} (c={args.concurrency})", latencies, elapsed)
+
+# =============================================================================
+# JSON ENCODING: JSONABLE_ENCODER + JSON.DUMPS VS ORJSON
+# =============================================================================
+
+def sample_documents() -> dict:
+    """A MOU and an invoice shaped like the ones the API stores"""
+    from bson import Decimal128
+
+    now = datetime.utcnow()
+    details = {"name": "Bench Co", "email": "billing@bench.example", "address": "1 Bench Street, Benchville",
+               "phone": "+1 555 0100", "tax_id": "BC-123456"}
+    mou = {
+        "_id": ObjectId(), "deal_id": str(ObjectId()), "my_details": details,
+        "client_details": {**details, "name": "Client Ltd"},
+        "project": {"name": "Website rebuild", "start_date": "2024-01-01", "end_date": "2024-06-30"},
+        "terms": {"scope": "Design and build. " * 40, "deliverables": [f"Deliverable {i}" for i in range(20)],
+                  "milestones": [{"name": f"Milestone {i}", "due": "2024-03-01", "amount": 1250.0} for i in range(8)]},
+        "status": "sent", "sign_token": uuid4().hex, "created_at": now, "updated_at": now,
+    }
+    invoice = {
+        "_id": ObjectId(), "deal_id": str(ObjectId()), "my_details": details,
+        "client_name": "Client Ltd", "project_name": "Website rebuild", "invoice_number": "INV-0042",
+        "invoice_date": "2024-02-01", "due_date": "2024-03-01", "amount": Decimal128("10000.00"), "currency": "USD",
+        "bank_details": {"bank": "Bench Bank", "iban": "GB00BENC00000000000000", "swift": "BENCGB2L",
+                         "account_name": "Bench Co"},
+        "payment_reference": "REF-0042", "status": "sent", "view_token": uuid4().hex,
+        "created_at": now, "updated_at": now,
+    }
+    return {"mou": mou, "invoice": invoice}
+
+def _encode_fastapi(doc: dict) -> bytes:
+    """The previous path: stringify _id in a copy, jsonable_encoder, then Starlette's json.dumps"""
+    from fastapi.encoders import jsonable_encoder
+
+    doc = {**doc, "_id": str(doc["_id"])}
+    if "amount" in doc:
+        doc["amount"] = float(doc["amount"].to_decimal())  # jsonable_encoder has no Decimal128 support
+    return json.dumps(jsonable_encoder(doc), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+def bench_json(args):
+    from responses import dumps
+
+    for name, doc in sample_documents().items():
+        print(f"{name}: {len(dumps(doc))} bytes")
+        for label, encode in (("jsonable_encoder+json", _encode_fastapi), ("orjson", dumps)):
+            for _ in range(100):  # warm-up
+                encode(doc)
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                t0 = time.perf_counter()
+                encode(doc)
+                latencies.append(time.perf_counter() - t0)
+            report(f"{name} {label}", latencies, time.perf_counter() - started)
+
+# =============================================================================
+# RAW BSON PASSTHROUGH FOR TOKEN DOCUMENTS
+# =============================================================================
+
+def _terms(size: int, clauses: bool) -> dict:
+    """A `terms` payload of roughly `size` bytes: one long text, or many short clauses"""
+    if not clauses:
+        return {"scope": "Design and build the agreed pages. " * (size // 35)}
+    return {"clauses": [{"title": f"Clause {i}", "text": "The parties agree to the following. " * 2}
+                        for i in range(size // 100)]}
+
+def _measure(convert, raw: bytes, iterations: int) -> tuple:
+    """(CPU seconds per call, peak bytes allocated by one call)"""
+    import tracemalloc
+
+    convert(raw)
+    tracemalloc.start()
+    convert(raw)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    started = time.process_time()
+    for _ in range(iterations):
+        convert(raw)
+    return (time.process_time() - started) / iterations, peak
+
+def bench_raw_bson(args):
+    import bson
+    from responses import dumps, bson_to_json
+    from tokens import to_stored, from_stored, load_tokens
+
+    paths = {
+        "decode+orjson": lambda raw: dumps(load_tokens(bson.decode(raw))),
+        "raw transcode": lambda raw: bson_to_json(raw, binary=from_stored),
+    }
+    for size in args.sizes:
+        for clauses in (False, True):
+            doc = {**sample_documents()["mou"], "terms": _terms(size, clauses)}
+            doc["sign_token"] = to_stored(doc["sign_token"])
+            raw = bson.encode(doc)
+            shape = "clauses" if clauses else "text"
+            for label, convert in paths.items():
+                cpu, peak = _measure(convert, raw, args.iterations)
+                print(f"{len(raw) / 1024:>8.1f} KiB {shape:<8} {label:<14} "
+                      f"cpu {cpu * 1e6:>9.1f} us/req   peak alloc {peak / 1024:>8.1f} KiB/req")
+
+# =============================================================================
+# POLLING TOKEN DOCUMENTS WITH AND WITHOUT CONDITIONAL GETS
+# =============================================================================
+
+async def _poll(port: int, paths: list, rounds: int, conditional: bool) -> tuple:
+    """Each path is polled `rounds` times by its own client; returns (latencies, elapsed, statuses, body bytes)"""
+    latencies, statuses, transferred = [], {}, [0]
+
+    async def client(path: str):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        etag = None
+        try:
+            for _ in range(rounds):
+                condition = f"If-None-Match: {etag}\r\n" if conditional and etag else ""
+                started = time.perf_counter()
+                writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\n{condition}\r\n".encode())
+                await writer.drain()
+                status, body, headers = await _read_response(reader)
+                latencies.append(time.perf_counter() - started)
+                statuses[status] = statuses.get(status, 0) + 1
+                transferred[0] += len(body)
+                etag = headers.get("etag", etag)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(path) for path in paths))
+    return latencies, time.perf_counter() - started, statuses, transferred[0]
+
+def bench_polling(args):
+    tokens = seed_invoices(args.clients)
+    database = bench_db()
+    database.invoice.update_many({}, {"$set": {"version": 1, "my_details.notes": "Payment terms. " * 200}})
+    paths = [f"/api/invoice/{token}" for token in tokens]
+    configs = (
+        ("full GET, cached", False, {}),
+        ("conditional, cached", True, {}),
+        ("conditional, uncached", True, {"TOKEN_CACHE_MAX_BYTES": "0"}),
+    )
+    for label, conditional, env in configs:
+        with serve("main:app", env=env) as port:
+            asyncio.run(_poll(port, paths[:10], 2, conditional))  # warm-up
+            latencies, elapsed, statuses, transferred = asyncio.run(_poll(port, paths, args.rounds, conditional))
+        report(label, latencies, elapsed)
+        print(f"{'':<28} statuses {statuses}; {transferred / len(latencies):>8.1f} body bytes/poll")
+
+# =============================================================================
+# IDLE SSE SUBSCRIBERS
+# =============================================================================
+
+def _rss_kib(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        return next(int(line.split()[1]) for line in status if line.startswith("VmRSS:"))
+
+async def _request(port: int, method: str, path: str, body: bytes = b"") -> tuple:
+    """One request on a fresh connection; returns (status, body)"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+    )
+    await writer.drain()
+    status, body, _ = await _read_response(reader)
+    writer.close()
+    return status, body
+
+async def _get(port: int, path: str) -> bytes:
+    return (await _request(port, "GET", path))[1]
+
+async def _subscribe(port: int, deal_id: str) -> tuple:
+    """Open an SSE subscription; returns (reader, writer) once the response headers arrived"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET /api/deal/events?deal_id={deal_id} HTTP/1.1\r\nHost: bench\r\n\r\n".encode())
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    return reader, writer
+
+async def _sse_idle(port: int, args) -> None:
+    pid = json.loads(await _get(port, "/healthz"))["pid"]
+    baseline = _rss_kib(pid)
+    connections = []
+    started = time.perf_counter()
+    for start in range(0, args.subscribers, 500):
+        count = min(500, args.subscribers - start)
+        connections += await asyncio.gather(*(_subscribe(port, str(ObjectId())) for _ in range(count)))
+    print(f"{len(connections)} idle subscribers connected in {time.perf_counter() - started:.1f}s; "
+          f"server RSS {baseline / 1024:.1f} -> {_rss_kib(pid) / 1024:.1f} MiB "
+          f"({(_rss_kib(pid) - baseline) / len(connections):.1f} KiB/subscriber)")
+
+    latencies, elapsed, _ = await _http_load(port, [("GET", "/healthz", None)] * 2000, 20)
+    report(f"/healthz with {len(connections)} idle", latencies, elapsed)
+
+    # Deliver one real status change to a handful of subscribers among the idle ones.
+    # The MOU is created through the API so the server knows its token.
+    status, body = await _request(port, "POST", "/api/mou", json.dumps({
+        "my_details": {"name": "Bench Co"},
+        "client_details": {"name": f"Client {uuid4().hex}"},
+        "project": {"name": "SSE"},
+        "terms": {},
+    }).encode())
+    if status != 200:
+        sys.exit(f"POST /api/mou returned {status}: {body[:200]!r}")
+    token = json.loads(body)["sign_url_token"]
+    deal_id = json.loads(await _get(port, f"/api/mou/{token}?fields=deal_id"))["deal_id"]
+    watchers = [await _subscribe(port, deal_id) for _ in range(args.watchers)]
+    started = time.perf_counter()
+    status, body = await _request(port, "POST", f"/api/mou/{token}/sign",
+                                  json.dumps({"name": "Bench", "title": "CEO", "agree": True}).encode())
+    if status != 200:
+        sys.exit(f"POST /api/mou/{{token}}/sign returned {status}: {body[:200]!r}")
+    delivered = []
+    for reader, _ in watchers:
+        try:
+            await asyncio.wait_for(reader.readuntil(b"event: status"), args.event_timeout)
+        except asyncio.TimeoutError:
+            sys.exit(f"no status event within {args.event_timeout}s of the sign")
+        delivered.append(time.perf_counter() - started)
+    print(f"sign -> event on {len(watchers)} watchers: "
+          f"first {min(delivered) * 1000:.1f} ms, last {max(delivered) * 1000:.1f} ms")
+
+    for _, writer in connections + watchers:
+        writer.close()
+
+def bench_sse_idle(args):
+    import resource
+    from database import INDEXES
+
+    # Both ends hold one socket per subscriber
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < args.subscribers * 2 + 100:
+        sys.exit(f"open file limit {hard} is too low for {args.subscribers} subscribers")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    database = bench_db()
+    for name in ("deal", "mou"):
+        database[name].drop()
+        database[name].create_indexes(INDEXES[name])
+    with serve("main:app") as port:
+        asyncio.run(_sse_idle(port, args))
+
+# =============================================================================
+# IDEMPOTENCY-KEY OVERHEAD
+# =============================================================================
+
+def bench_idempotency(args):
+    from database import INDEXES
+
+    database = bench_db()
+    for name in ("deal", "mou", "idempotency"):
+        database[name].drop()
+        database[name].create_indexes(INDEXES[name])
+
+    def body(i: int) -> bytes:
+        return json.dumps({
+            "my_details": {"name": "Bench Co"},
+            "client_details": {"name": f"Client {i % 100}"},
+            "project": {"name": f"Project {i % 100}"},
+            "terms": {"scope": "x" * 200},
+        }).encode()
+
+    replay_keys = [uuid4().hex for _ in range(100)]
+    workloads = (
+        ("no key", lambda i: ("POST", "/api/mou", body(i))),
+        ("unique keys", lambda i: ("POST", "/api/mou", body(i), {"Idempotency-Key": uuid4().hex})),
+        ("replayed keys", lambda i: ("POST", "/api/mou", body(i % 100), {"Idempotency-Key": replay_keys[i % 100]})),
+    )
+    with serve("main:app") as port:
+        for label, make in workloads:
+            requests = [make(i) for i in range(args.requests)]
+            if label == "replayed keys":
+                http_load(port, requests[:100], 1)  # store each key's response once
+            latencies, elapsed, statuses = http_load(port, requests, args.concurrency)
+            report(f"{label} (c={args.concurrency})", latencies, elapsed)
+            print(f"{'':<28} statuses {statuses}")
+    print(f"{database.mou.count_documents({})} MOUs, {database.idempotency.count_documents({})} stored keys")
+
+# =============================================================================
+# STREAMING EXPORT MEMORY
+# =============================================================================
+
+def seed_export_invoices(count: int, batch: int = 10000):
+    """Seed `count` paid/sent invoices for the export benchmark, in batches"""
+    from database import INDEXES
+
+    database = bench_db()
+    database.invoice.drop()
+    database.invoice.create_indexes(INDEXES["invoice"])
+    now = datetime.now(timezone.utc)
+    for start in range(0, count, batch):
+        database.invoice.insert_many([
+            {"deal_id": str(ObjectId()), "my_details": {"name": "Bench Co", "address": "1 Bench Street"},
+             "client_name": f"Client {i % 1000}", "project_name": f"Project {i}",
+             "invoice_number": f"INV-{i}", "invoice_date": "2024-01-01", "amount": 1000.0 + i % 100,
+             "currency": "USD", "bank_details": {"iban": "GB00BENCH0000000000"}, "payment_reference": f"REF-{i}",
+             "status": "paid" if i % 2 else "sent", "view_token": uuid4().hex, "version": 1,
+             "created_at": now, "updated_at": now}
+            for i in range(start, min(start + batch, count))
+        ], ordered=False)
+
+_EXPORT_KEY = uuid4().hex
+
+async def _export(port: int, path: str, interval: float = 0.1) -> tuple:
+    """Stream GET `path` to the end, discarding it while sampling server RSS; returns (bytes, peak RSS KiB)"""
+    pid = json.loads(await _get(port, "/healthz"))["pid"]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: bench\r\nX-Export-Key: {_EXPORT_KEY}\r\n"
+                 f"Connection: close\r\n\r\n".encode())
+    await writer.drain()
+    received, peak, sampled = 0, _rss_kib(pid), time.monotonic()
+    while True:
+        data = await reader.read(256 * 1024)
+        if not data:
+            break
+        received += len(data)
+        if time.monotonic() - sampled >= interval:
+            peak, sampled = max(peak, _rss_kib(pid)), time.monotonic()
+    writer.close()
+    return received, max(peak, _rss_kib(pid))
+
+def bench_export_rss(args):
+    started = time.perf_counter()
+    seed_export_invoices(args.invoices)
+    print(f"seeded {args.invoices} invoices in {time.perf_counter() - started:.1f}s")
+    failed = False
+    with serve("main:app", env={"EXPORT_API_KEY": _EXPORT_KEY}) as port:
+        pid = json.loads(asyncio.run(_get(port, "/healthz")))["pid"]
+        for fmt in ("csv", "ndjson"):
+            baseline = _rss_kib(pid)
+            started = time.perf_counter()
+            received, peak = asyncio.run(_export(port, f"/api/export/invoice?format={fmt}"))
+            elapsed = time.perf_counter() - started
+            growth = (peak - baseline) / 1024
+            print(f"{fmt:<7} {received / 1024 / 1024:>8.1f} MiB in {elapsed:>6.1f}s"
+                  f"  ({args.invoices / elapsed:>9.0f} rows/s)"
+                  f"  server RSS {baseline / 1024:.1f} -> peak {peak / 1024:.1f} MiB (+{growth:.1f})")
+            failed = failed or growth > args.max_rss_mib
+    if failed:
+        sys.exit(f"FAIL: server RSS grew by more than {args.max_rss_mib} MiB during an export")
+
+# =============================================================================
+# ENTRY POINT
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("sync-vs-async", help="threadpool (def) vs async endpoints: req/s and p99")
+    cmd.add_argument("--requests", type=int, default=5000)
+    cmd.add_argument("--concurrency", type=int, default=200)
+    cmd.set_defaults(func=bench_sync_vs_async)
+
+    cmd = commands.add_parser("snapshot", help="deal snapshot: four sequential queries vs one aggregation")
+    cmd.add_argument("--deals", type=int, default=100000)
+    cmd.add_argument("--lookups", type=int, default=2000)
+    cmd.set_defaults(func=bench_snapshot)
+
+    cmd = commands.add_parser("token-cache", help="GET /api/mou/{token} with and without the token cache")
+    cmd.add_argument("--tokens", type=int, default=200, help="size of the hot token set")
+    cmd.add_argument("--requests", type=int, default=10000)
+    cmd.add_argument("--concurrency", type=int, default=50)
+    cmd.set_defaults(func=bench_token_cache)
+
+    cmd = commands.add_parser("paid-race", help="parallel duplicate POST .../paid; fails unless one receipt per invoice")
+    cmd.add_argument("--invoices", type=int, default=500)
+    cmd.add_argument("--duplicates", type=int, default=8)
+    cmd.add_argument("--concurrency", type=int, default=64)
+    cmd.set_defaults(func=bench_paid_race)
+
+    cmd = commands.add_parser("deal-growth", help="concurrent POST /api/mou for few pairs; fails on duplicate deals")
+    cmd.add_argument("--pairs", type=int, default=50)
+    cmd.add_argument("--requests", type=int, default=5000)
+    cmd.add_argument("--concurrency", type=int, default=100)
+    cmd.set_defaults(func=bench_deal_growth)
+
+    cmd = commands.add_parser("serve-modes", help="serve.py dev vs prod: req/s and p99 for /healthz and MOU lookups")
+    cmd.add_argument("--workers", type=int, default=0, help="prod workers (default: one per CPU)")
+    cmd.add_argument("--requests", type=int, default=20000)
+    cmd.add_argument("--concurrency", type=int, default=100)
+    cmd.set_defaults(func=bench_serve_modes)
+
+    cmd = commands.add_parser("json", help="encode MOU/invoice documents: jsonable_encoder+json.dumps vs orjson")
+    cmd.add_argument("--iterations", type=int, default=20000)
+    cmd.set_defaults(func=bench_json)
+
+    cmd = commands.add_parser("raw-bson", help="token document to JSON: decode+orjson vs raw BSON transcoding")
+    cmd.add_argument("--sizes", type=int, nargs="+", default=[4096, 65536, 1048576], help="terms sizes in bytes")
+    cmd.add_argument("--iterations", type=int, default=200)
+    cmd.set_defaults(func=bench_raw_bson)
+
+    cmd = commands.add_parser("polling", help="clients polling GET /api/invoice/{token}: full GETs vs If-None-Match")
+    cmd.add_argument("--clients", type=int, default=200)
+    cmd.add_argument("--rounds", type=int, default=50)
+    cmd.set_defaults(func=bench_polling)
+
+    cmd = commands.add_parser("sse-idle", help="memory and responsiveness with thousands of idle SSE subscribers")
+    cmd.add_argument("--subscribers", type=int, default=5000)
+    cmd.add_argument("--watchers", type=int, default=10, help="subscribers of the deal that changes")
+    cmd.add_argument("--event-timeout", type=float, default=10, help="seconds to wait for each status event")
+    cmd.set_defaults(func=bench_sse_idle)
+
+    cmd = commands.add_parser("idempotency", help="POST /api/mou without a key, with unique keys, and replayed")
+    cmd.add_argument("--requests", type=int, default=5000)
+    cmd.add_argument("--concurrency", type=int, default=50)
+    cmd.set_defaults(func=bench_idempotency)
+
+    cmd = commands.add_parser("export-rss", help="stream GET /api/export/invoice; fails if server RSS is not bounded")
+    cmd.add_argument("--invoices", type=int, default=1000000)
+    cmd.add_argument("--max-rss-mib", type=float, default=64, help="allowed server RSS growth during one export")
+    cmd.set_defaults(func=bench_export_rss)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+In-Process Caches
+
+Small caching primitives used by the API to avoid MongoDB round trips. They keep
+no locks and are meant to be used from the event loop thread only.
+"""
+
+import sys
+import math
+import asyncio
+import time
+import hashlib
+from collections import OrderedDict
+
+import bson
+from bson.errors import InvalidDocument
+
+def approximate_size(value) -> int:
+    """Rough memory cost of a cached value: BSON size for documents, sys.getsizeof otherwise"""
+    if isinstance(value, dict):
+        try:
+            return len(bson.encode(value))
+        except (TypeError, InvalidDocument):
+            pass
+    return sys.getsizeof(value)
+
+class TTLCache:
+    """LRU cache whose entries expire after `ttl` seconds, bounded by an approximate byte budget
+
+    max_bytes <= 0 disables the cache (every get() is a miss, set() stores nothing).
+    Entries may carry a tag so that related keys can be dropped together with invalidate_tag().
+
+    A read-through caller takes generation(tag) before reading the source and passes it to
+    set(): if invalidate_tag() ran in between, the value may predate the write and is not
+    stored (counted in `stale_sets`). Invalidations are remembered for `ttl` seconds, so a
+    read that outlasts the TTL is not guarded.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, sizeof=approximate_size):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale_sets = 0
+        self._entries = OrderedDict()  # key -> (expires_at, size, value, tag)
+        self._tags = {}  # tag -> {keys}
+        self._clock = 0
+        self._invalidated = OrderedDict()  # tag -> (generation, invalidated_at), oldest first
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, size, value, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def generation(self, tag) -> int:
+        """Token to pass to set(); changes whenever `tag` is invalidated"""
+        entry = self._invalidated.get(tag)
+        return entry[0] if entry is not None else 0
+
+    def set(self, key, value, tag=None, generation=None):
+        if self.max_bytes <= 0:
+            return
+        if generation is not None and self.generation(tag) != generation:
+            self.stale_sets += 1
+            return
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value, tag)
+        self.bytes += size
+        if tag is not None:
+            self._tags.setdefault(tag, set()).add(key)
+        # Evict least recently used entries until we are back under budget
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self._entries:
+            self._remove(key)
+
+    def invalidate_tag(self, tag):
+        for key in list(self._tags.get(tag, ())):
+            self._remove(key)
+        now = time.monotonic()
+        self._clock += 1
+        self._invalidated.pop(tag, None)
+        self._invalidated[tag] = (self._clock, now)
+        while self._invalidated:
+            oldest, (_, invalidated_at) = next(iter(self._invalidated.items()))
+            if invalidated_at > now - self.ttl:
+                break
+            del self._invalidated[oldest]
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+        self.bytes = 0
+
+    def _remove(self, key):
+        _, size, _, tag = self._entries.pop(key)
+        self.bytes -= size
+        if tag is not None:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale_sets": self.stale_sets,
+        }
+
+class BloomFilter:
+    """Probabilistic set membership: no false negatives, false positives at about `error_rate`
+
+    Sized for `capacity` items; adding more than that raises the false-positive rate,
+    which estimated_error_rate() reports.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # Double hashing: two 64-bit halves of one digest generate all k positions
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def estimated_error_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def stats(self) -> dict:
+        return {
+            "items": self.count,
+            "capacity": self.capacity,
+            "target_error_rate": self.error_rate,
+            "estimated_error_rate": round(self.estimated_error_rate(), 8),
+            "hashes": self.hashes,
+            "memory_bytes": len(self._bits),
+        }
+
+class SingleFlight:
+    """Concurrent calls for the same key share one in-flight call and its result
+
+    The shared call runs in its own task, so a caller that is cancelled (say, its client
+    disconnected) does not cancel it for the others. Results are shared, not copied:
+    callers must not mutate them.
+
+    Calls may carry a tag; forget_tag() (after a write) makes later callers start a fresh
+    call instead of joining one that may have read the data before the write.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight = {}  # key -> asyncio.Task
+        self._tags = {}  # tag -> {keys}
+
+    async def do(self, key, func, tag=None):
+        """Result of `await func()`, or of the identical call already in flight"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            task.add_done_callback(lambda done: self._done(key, done, tag))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def forget_tag(self, tag):
+        """Stop sharing the in-flight calls tagged `tag`; their current waiters still get the result"""
+        for key in self._tags.pop(tag, ()):
+            self._inflight.pop(key, None)
+
+    def _done(self, key, task, tag):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        # Mark the exception as retrieved when every waiter has gone away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._inflight), "calls": self.calls, "coalesced": self.coalesced}
@@ -5,9 +5,22 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo import ReturnDocument, monitoring
+from pymongo.errors import PyMongoError, BulkWriteError, WriteError, DuplicateKeyError
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
+from concurrent.futures import Future
 import os
+import time
+import bisect
+import asyncio
+import threading
+import json
+import base64
+import logging
 from dotenv import load_dotenv
 from typing import Union
 from pydantic import BaseModel
@@ -15,41 +28,760 @@ from pydantic import BaseModel
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
-db = None
+logger = logging.getLogger(__name__)
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+# --------- Connection pool metrics ---------
 
-# Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+class PoolWaitMetrics(monitoring.ConnectionPoolListener):
+    """Time spent waiting to check a connection out of the pool
+
+    pymongo checks connections out on the calling thread (Motor's executor
+    threads for async_db), so the start of each wait is kept thread-locally.
+    """
+
+    BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.failures = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(self.BUCKETS_MS) + 1)
+
+    def _record(self, failed: bool):
+        started = getattr(self._local, "started", None)
+        if started is None:
+            return
+        self._local.started = None
+        waited_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.checkouts += 1
+            self.failures += failed
+            self.total_ms += waited_ms
+            self.max_ms = max(self.max_ms, waited_ms)
+            self.histogram[bisect.bisect_left(self.BUCKETS_MS, waited_ms)] += 1
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        self._record(failed=False)
+
+    def connection_check_out_failed(self, event):
+        self._record(failed=True)
+
+    # Remaining pool events are not needed
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): pass
+    def connection_checked_in(self, event): pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            buckets = [f"le_{bound}ms" for bound in self.BUCKETS_MS] + ["le_inf"]
+            return {
+                "checkouts": self.checkouts,
+                "failures": self.failures,
+                "mean_ms": round(self.total_ms / self.checkouts, 3) if self.checkouts else 0.0,
+                "max_ms": round(self.max_ms, 3),
+                "histogram": dict(zip(buckets, self.histogram)),
+            }
+
+pool_wait = PoolWaitMetrics()
+
+# --------- Clients ---------
+# The sync client (`db`) is created on first use, so importing this module opens no
+# connections (safe before forking workers). The async client (`async_db`) is opened
+# and closed by the application's lifespan via open_async()/close_async().
+
+def client_options() -> dict:
+    """MongoClient pool settings from the environment"""
+    return {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "event_listeners": [pool_wait],
+    }
+
+_client = None
+db = None
+
+_async_client = None
+async_db = None
+
+def get_db():
+    """Sync database handle, connecting on first use"""
+    global _client, db
+    if db is None and database_url and database_name:
+        _client = MongoClient(database_url, **client_options())
+        db = _client[database_name]
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    return db
+
+def close():
+    """Close the sync client (if it was opened)"""
+    global _client, db
+    if _client is not None:
+        _client.close()
+    _client = db = None
+
+async def open_async():
+    """Open the async client, fail fast if the server is unreachable, and pre-warm it
+
+    Opens minPoolSize connections up front and loads the index metadata of every
+    collection in INDEXES, so the first requests do not pay for either.
+    Returns the database handle, or None when no database is configured.
+    """
+    global _async_client, async_db
+    if not (database_url and database_name):
+        return None
+    options = client_options()
+    _async_client = AsyncIOMotorClient(database_url, **options)
+    async_db = _async_client[database_name]
+    try:
+        # Concurrent pings force min_pool_size separate connections
+        await asyncio.gather(*(async_db.command("ping") for _ in range(max(1, options["minPoolSize"]))))
+        await asyncio.gather(*(async_db[name].index_information() for name in INDEXES))
+    except Exception:
+        await close_async()
+        raise
+    return async_db
+
+async def close_async():
+    """Close the async client"""
+    global _async_client, async_db
+    if _async_client is not None:
+        _async_client.close()
+    _async_client = async_db = None
+
+# How long an Idempotency-Key and its stored response are kept
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+
+# Indexes backing every lookup the API performs, keyed by collection name.
+# create_indexes() is a no-op for indexes that already exist, so this is safe to run on every startup.
+INDEXES = {
+    "deal": [
+        IndexModel([("client_name", ASCENDING), ("project_name", ASCENDING)], name="client_project_unique", unique=True),
+    ],
+    "mou": [
+        IndexModel([("sign_token", ASCENDING)], name="sign_token_unique", unique=True),
+        IndexModel([("deal_id", ASCENDING), ("created_at", DESCENDING)], name="deal_latest"),
+    ],
+    "invoice": [
+        IndexModel([("view_token", ASCENDING)], name="view_token_unique", unique=True),
+        IndexModel([("deal_id", ASCENDING), ("created_at", DESCENDING)], name="deal_latest"),
+    ],
+    "receipt": [
+        # One receipt per invoice: mark_invoice_paid upserts against this index
+        IndexModel([("invoice_token", ASCENDING)], name="invoice_token_unique", unique=True),
+    ],
+    "idempotency": [
+        # Stored POST responses expire on their own (see idempotency.py)
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS),
+    ],
+}
+
+def ensure_indexes():
+    """Create all declared indexes; returns {collection: [index names]}"""
+    db = get_db()
+
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created[collection_name] = db[collection_name].create_indexes(indexes)
+        except PyMongoError as e:
+            logger.error("Could not create indexes on %s: %s", collection_name, e)
+    return created
+
+async def ensure_indexes_async():
+    """Create all declared indexes without blocking the event loop; errors are logged, not raised"""
+    if async_db is None:
+        return {}
+
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created[collection_name] = await async_db[collection_name].create_indexes(indexes)
+        except PyMongoError as e:
+            logger.error("Could not create indexes on %s: %s", collection_name, e)
+    return created
 
+# Helper functions for common database operations
+def _prepare_document(data: Union[BaseModel, dict], now: datetime = None) -> dict:
+    """Convert input to a dict and stamp created_at/updated_at"""
     # Convert Pydantic model to dict if needed
     if isinstance(data, BaseModel):
         data_dict = data.model_dump()
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = now or datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+    return data_dict
+
+def create_document(collection_name: str, data: Union[BaseModel, dict], coalesce: bool = False,
+                    document_id: ObjectId = None):
+    """Insert a single document with timestamp
 
+    document_id sets a pre-allocated _id. With coalesce=True the insert is batched with concurrent inserts into the
+    same collection (see WriteCoalescer); the call still returns this
+    document's own id once its batch is written.
+    """
+    db = get_db()
+
+    data_dict = _prepare_document(data)
+    if document_id is not None:
+        data_dict["_id"] = document_id
+    if coalesce:
+        return get_coalescer(collection_name).submit(data_dict).result()
     result = db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
-    if db is None:
-        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
+def create_documents(collection_name: str, items: list):
+    """Insert many documents in one unordered insert_many; returns their ids in input order"""
+    db = get_db()
+    if not items:
+        return []
+
+    now = datetime.now(timezone.utc)
+    result = db[collection_name].insert_many([_prepare_document(item, now) for item in items], ordered=False)
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+def _upsert_spec(filter_dict: dict, data: Union[BaseModel, dict]) -> tuple:
+    """($setOnInsert update, pre-allocated _id) for get_or_create_document"""
+    data_dict = _prepare_document(data)
+    data_dict.setdefault("_id", ObjectId())
+    # Fields in the filter are copied into the new document by the upsert itself
+    on_insert = {key: value for key, value in data_dict.items() if key not in filter_dict}
+    return {"$setOnInsert": on_insert}, data_dict["_id"]
+
+def get_or_create_document(collection_name: str, filter_dict: dict, data: Union[BaseModel, dict]):
+    """Insert `data` unless a document matching filter_dict exists, in one round trip
+
+    Returns (id, created). Back filter_dict with a unique index: concurrent callers
+    then all get the same document, the losers after one DuplicateKeyError retry.
+    """
+    db = get_db()
+
+    update, new_id = _upsert_spec(filter_dict, data)
+    for attempt in range(2):
+        try:
+            existing = db[collection_name].find_one_and_update(
+                filter_dict, update, upsert=True, projection={"_id": 1},
+                return_document=ReturnDocument.BEFORE,
+            )
+        except DuplicateKeyError:
+            if attempt:
+                raise
+            continue
+        return (str(existing["_id"]), False) if existing else (str(new_id), True)
+
+# --------- Write coalescing ---------
+# Analytics-style writers issue thousands of tiny inserts. A WriteCoalescer gathers
+# the inserts that arrive within a short window (or until max_batch documents are
+# queued) and writes them with a single insert_many, resolving one future per caller.
+
+WRITE_COALESCE_WINDOW_MS = float(os.getenv("WRITE_COALESCE_WINDOW_MS", "2"))
+WRITE_COALESCE_MAX_BATCH = int(os.getenv("WRITE_COALESCE_MAX_BATCH", "500"))
+
+class WriteCoalescer:
+    """Batches concurrent single-document inserts into one collection"""
+
+    def __init__(self, collection_name: str, window_ms: float = WRITE_COALESCE_WINDOW_MS,
+                 max_batch: int = WRITE_COALESCE_MAX_BATCH):
+        self.collection_name = collection_name
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.documents = 0
+        self._pending = []
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def submit(self, doc: dict) -> Future:
+        """Queue a prepared document; the future resolves to its id as a string"""
+        # Assign the id client-side so every caller can be answered from one insert_many
+        doc.setdefault("_id", ObjectId())
+        future = Future()
+        with self._cond:
+            self._pending.append((doc, future))
+            # (Re)start the worker if there is none or it died
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name=f"coalesce-{self.collection_name}", daemon=True
+                )
+                self._worker.start()
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+            try:
+                self._flush(batch)
+            except Exception:
+                # Keep the worker alive for the inserts queued behind this batch
+                logger.exception("Coalesced insert into %s failed", self.collection_name)
+
+    def _flush(self, batch: list):
+        # Callers that were cancelled (asyncio.wrap_future cancels the Future) gave up on
+        # their insert: leave it out. The rest can no longer be cancelled once running.
+        batch = [(doc, future) for doc, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        failed = {}
+        try:
+            get_db()[self.collection_name].insert_many([doc for doc, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            # Unordered: everything except the reported indexes was written
+            failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.documents += len(batch) - len(failed)
+        for index, (doc, future) in enumerate(batch):
+            if index in failed:
+                error = failed[index]
+                future.set_exception(WriteError(error.get("errmsg"), error.get("code"), error))
+            else:
+                future.set_result(str(doc["_id"]))
+
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+def get_coalescer(collection_name: str) -> WriteCoalescer:
+    """Shared WriteCoalescer for a collection"""
+    with _coalescers_lock:
+        if collection_name not in _coalescers:
+            _coalescers[collection_name] = WriteCoalescer(collection_name)
+        return _coalescers[collection_name]
+
+def write_coalescing_stats() -> dict:
+    """Batches and documents written per coalesced collection"""
+    return {
+        name: {"batches": c.batches, "documents": c.documents}
+        for name, c in list(_coalescers.items())
+    }
+
+def _find(collection, filter_dict: dict = None, projection: dict = None, sort: list = None,
+          limit: int = None, skip: int = None, batch_size: int = None):
+    """Build a find() cursor; works for both pymongo and Motor collections"""
+    cursor = collection.find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if skip:
+        cursor = cursor.skip(skip)
     if limit:
         cursor = cursor.limit(limit)
-    
-    return list(cursor)
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+    return cursor
+
+def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None,
+                  projection: dict = None, sort: list = None, skip: int = None,
+                  batch_size: int = None, stream: bool = False):
+    """Get documents from collection
+
+    With stream=True a generator is returned instead of a list, so large
+    collections are pulled `batch_size` documents at a time.
+    """
+    db = get_db()
+
+    if stream:
+        return iter_documents(collection_name, filter_dict, limit, projection, sort, skip, batch_size)
+    return list(_find(db[collection_name], filter_dict, projection, sort, limit, skip, batch_size))
+
+def iter_documents(collection_name: str, filter_dict: dict = None, limit: int = None,
+                   projection: dict = None, sort: list = None, skip: int = None,
+                   batch_size: int = None):
+    """Yield documents lazily, fetching `batch_size` per round trip"""
+    db = get_db()
+
+    cursor = _find(db[collection_name], filter_dict, projection, sort, limit, skip, batch_size)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
+# --------- Keyset pagination ---------
+# Pages are ordered by (created_at, _id) and resumed from the last document seen,
+# so deep pages cost the same as the first one (no skip()).
+
+def encode_resume_token(doc: dict) -> str:
+    """Opaque token pointing just past `doc` in (created_at, _id) order"""
+    created_at = doc.get("created_at")
+    payload = {"c": created_at.isoformat() if created_at else None, "i": str(doc["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_resume_token(token: str) -> tuple:
+    """Inverse of encode_resume_token; returns (created_at, ObjectId)"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        created_at = datetime.fromisoformat(payload["c"]) if payload["c"] else None
+        return created_at, ObjectId(payload["i"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise ValueError("Invalid resume token") from None
+
+def _page_query(filter_dict: dict = None, resume_token: str = None, projection: dict = None,
+                descending: bool = False) -> tuple:
+    """Return (filter, projection, sort) for one keyset page"""
+    direction = DESCENDING if descending else ASCENDING
+    sort = [("created_at", direction), ("_id", direction)]
+
+    conditions = [filter_dict] if filter_dict else []
+    if resume_token:
+        created_at, last_id = decode_resume_token(resume_token)
+        op = "$lt" if descending else "$gt"
+        resume = [{"created_at": created_at, "_id": {op: last_id}}]
+        # Documents without created_at sort before every date; comparisons with a date or
+        # with null never cross that boundary, so it needs a branch of its own
+        if created_at is None:
+            if not descending:
+                resume.append({"created_at": {"$ne": None}})
+        else:
+            resume.append({"created_at": {op: created_at}})
+            if descending:
+                resume.append({"created_at": None})
+        conditions.append({"$or": resume})
+    query = {"$and": conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+
+    # The cursor fields must survive an inclusion projection to build the next token
+    if projection and any(projection.values()):
+        projection = {**projection, "created_at": 1}
+    return query, projection, sort
+
+def _page_result(docs: list, page_size: int) -> tuple:
+    if len(docs) > page_size:
+        docs = docs[:page_size]
+        return docs, encode_resume_token(docs[-1])
+    return docs, None
+
+def get_page(collection_name: str, filter_dict: dict = None, page_size: int = 50,
+             resume_token: str = None, projection: dict = None, descending: bool = False):
+    """Get one page of documents; returns (documents, next_resume_token or None)"""
+    db = get_db()
+
+    query, projection, sort = _page_query(filter_dict, resume_token, projection, descending)
+    # One extra document tells us whether another page exists
+    docs = list(_find(db[collection_name], query, projection, sort, page_size + 1))
+    return _page_result(docs, page_size)
+
+# --------- Updates and deletes ---------
+
+def _id_filter(filter_or_id) -> dict:
+    """Accept a filter dict or a document id (ObjectId or its string form)"""
+    if isinstance(filter_or_id, dict):
+        return filter_or_id
+    if isinstance(filter_or_id, str) and ObjectId.is_valid(filter_or_id):
+        return {"_id": ObjectId(filter_or_id)}
+    return {"_id": filter_or_id}
+
+def _update_spec(update_data: Union[BaseModel, dict], now: datetime = None) -> dict:
+    """Wrap plain field values in $set (operator updates pass through) and bump updated_at"""
+    if isinstance(update_data, BaseModel):
+        update_data = update_data.model_dump(exclude_unset=True)
+    if any(key.startswith("$") for key in update_data):
+        spec = dict(update_data)
+        spec["$set"] = dict(spec.get("$set", {}))
+    else:
+        spec = {"$set": dict(update_data)}
+    spec["$set"]["updated_at"] = now or datetime.now(timezone.utc)
+    return spec
+
+def update_document(collection_name: str, filter_or_id, update_data: Union[BaseModel, dict], upsert: bool = False):
+    """Update one document by id or filter; returns the number of modified documents"""
+    db = get_db()
+
+    result = db[collection_name].update_one(_id_filter(filter_or_id), _update_spec(update_data), upsert=upsert)
+    return result.modified_count
+
+def delete_document(collection_name: str, filter_or_id):
+    """Delete one document by id or filter; returns the number of deleted documents"""
+    db = get_db()
+
+    result = db[collection_name].delete_one(_id_filter(filter_or_id))
+    return result.deleted_count
+
+# --------- Batched mutations ---------
+# A MutationBatch queues updates and deletes and sends them as one bulk_write per
+# collection. ordered=True stops at the first failure (later operations are reported
+# as "skipped"); ordered=False lets the server apply everything it can and, in the
+# async flush, writes all collections concurrently.
+
+class MutationBatch:
+    """Queue of updates/deletes flushed with one bulk_write per collection"""
+
+    def __init__(self, ordered: bool = True):
+        self.ordered = ordered
+        self._operations = []
+
+    def __len__(self):
+        return len(self._operations)
+
+    def update(self, collection_name: str, filter_or_id, update_data: Union[BaseModel, dict],
+               upsert: bool = False, many: bool = False):
+        """Queue an update; returns its position in the batch"""
+        request_class = UpdateMany if many else UpdateOne
+        request = request_class(_id_filter(filter_or_id), _update_spec(update_data), upsert=upsert)
+        self._operations.append((collection_name, "update", request))
+        return len(self._operations) - 1
+
+    def delete(self, collection_name: str, filter_or_id, many: bool = False):
+        """Queue a delete; returns its position in the batch"""
+        request_class = DeleteMany if many else DeleteOne
+        self._operations.append((collection_name, "delete", request_class(_id_filter(filter_or_id))))
+        return len(self._operations) - 1
+
+    def _take(self) -> tuple:
+        """Drain the queue; returns (operations, {collection: [position, ...]}, pending results)"""
+        operations, self._operations = self._operations, []
+        groups = {}
+        for position, (collection_name, _, _) in enumerate(operations):
+            groups.setdefault(collection_name, []).append(position)
+        results = [
+            {"collection": collection_name, "op": kind, "status": "pending", "upserted_id": None, "error": None}
+            for collection_name, kind, _ in operations
+        ]
+        return operations, groups, results
+
+    def _record(self, results: list, positions: list, outcome) -> dict:
+        """Fill per-operation results for one collection from a BulkWriteResult or an exception"""
+        if isinstance(outcome, BulkWriteError):
+            details = outcome.details
+            errors = {error["index"]: error.get("errmsg") for error in details.get("writeErrors", [])}
+            upserted = {item["index"]: item["_id"] for item in details.get("upserted", [])}
+            first_error = min(errors) if errors else None
+        elif isinstance(outcome, Exception):
+            details = {}
+            errors = {index: str(outcome) for index in range(len(positions))}
+            upserted = {}
+            first_error = 0
+        else:
+            details = outcome.bulk_api_result
+            errors = {}
+            upserted = outcome.upserted_ids or {}
+            first_error = None
+
+        for index, position in enumerate(positions):
+            result = results[position]
+            if index in errors:
+                result["status"], result["error"] = "error", errors[index]
+            elif self.ordered and first_error is not None and index > first_error:
+                result["status"] = "skipped"
+            else:
+                result["status"] = "ok"
+                if index in upserted:
+                    result["upserted_id"] = str(upserted[index])
+        return {
+            "matched": details.get("nMatched", 0),
+            "modified": details.get("nModified", 0),
+            "deleted": details.get("nRemoved", 0),
+            "upserted": details.get("nUpserted", 0),
+        }
+
+    @staticmethod
+    def _summary(results: list, counts: dict) -> dict:
+        for result in results:
+            if result["status"] == "pending":
+                result["status"] = "skipped"
+        return {
+            "ok": all(result["status"] == "ok" for result in results),
+            "results": results,
+            "collections": counts,
+        }
+
+    def flush(self) -> dict:
+        """Write all queued operations; returns per-operation results in queue order"""
+        db = get_db()
+
+        operations, groups, results = self._take()
+        counts = {}
+        for collection_name, positions in groups.items():
+            requests = [operations[position][2] for position in positions]
+            try:
+                outcome = db[collection_name].bulk_write(requests, ordered=self.ordered)
+            except PyMongoError as e:
+                outcome = e
+            counts[collection_name] = self._record(results, positions, outcome)
+            if self.ordered and isinstance(outcome, Exception):
+                break
+        return self._summary(results, counts)
+
+    async def flush_async(self) -> dict:
+        """Async flush; unordered batches write every collection concurrently"""
+        if async_db is None:
+            raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+        operations, groups, results = self._take()
+
+        async def write(collection_name: str, positions: list):
+            requests = [operations[position][2] for position in positions]
+            try:
+                return await async_db[collection_name].bulk_write(requests, ordered=self.ordered)
+            except PyMongoError as e:
+                return e
+
+        counts = {}
+        if self.ordered:
+            for collection_name, positions in groups.items():
+                outcome = await write(collection_name, positions)
+                counts[collection_name] = self._record(results, positions, outcome)
+                if isinstance(outcome, Exception):
+                    break
+        else:
+            outcomes = await asyncio.gather(*(write(name, positions) for name, positions in groups.items()))
+            for (collection_name, positions), outcome in zip(groups.items(), outcomes):
+                counts[collection_name] = self._record(results, positions, outcome)
+        return self._summary(results, counts)
+
+# Async variants for use inside `async def` endpoints (do not block the event loop)
+async def create_document_async(collection_name: str, data: Union[BaseModel, dict], coalesce: bool = False,
+                                document_id: ObjectId = None, session=None):
+    """Insert a single document with timestamp (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    data_dict = _prepare_document(data)
+    if document_id is not None:
+        data_dict["_id"] = document_id
+    if coalesce:
+        return await asyncio.wrap_future(get_coalescer(collection_name).submit(data_dict))
+    result = await async_db[collection_name].insert_one(data_dict, session=session)
+    return str(result.inserted_id)
+
+async def create_documents_async(collection_name: str, items: list):
+    """Insert many documents in one unordered insert_many; returns their ids in input order (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    if not items:
+        return []
+
+    now = datetime.now(timezone.utc)
+    result = await async_db[collection_name].insert_many([_prepare_document(item, now) for item in items], ordered=False)
+    return [str(inserted_id) for inserted_id in result.inserted_ids]
+
+async def get_or_create_document_async(collection_name: str, filter_dict: dict, data: Union[BaseModel, dict],
+                                      session=None):
+    """Insert `data` unless a document matching filter_dict exists; returns (id, created) (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    update, new_id = _upsert_spec(filter_dict, data)
+    for attempt in range(2):
+        try:
+            existing = await async_db[collection_name].find_one_and_update(
+                filter_dict, update, upsert=True, projection={"_id": 1},
+                return_document=ReturnDocument.BEFORE, session=session,
+            )
+        except DuplicateKeyError:
+            if attempt:
+                raise
+            continue
+        return (str(existing["_id"]), False) if existing else (str(new_id), True)
+
+# --------- Transactions ---------
+# Multi-document transactions need a replica set or sharded cluster. DB_TRANSACTIONS=1
+# opts in; on a standalone server run_in_transaction_async() falls back to no session.
+
+DB_TRANSACTIONS = os.getenv("DB_TRANSACTIONS", "0") in ("1", "true", "True")
+_transactions_supported = None
+
+async def transactions_supported() -> bool:
+    """Whether transactions are enabled and the server topology supports them (checked once)"""
+    global _transactions_supported
+    if not DB_TRANSACTIONS or async_db is None:
+        return False
+    if _transactions_supported is None:
+        hello = await async_db.command("hello")
+        _transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+    return _transactions_supported
+
+async def run_in_transaction_async(callback):
+    """Await callback(session) inside a transaction when supported, else callback(None)
+
+    The callback may be re-run on transient transaction errors, so it must only
+    write documents whose ids it allocated itself or that it upserts.
+    """
+    if not await transactions_supported():
+        return await callback(None)
+    async with await _async_client.start_session() as session:
+        return await session.with_transaction(callback)
+
+async def update_document_async(collection_name: str, filter_or_id, update_data: Union[BaseModel, dict],
+                                upsert: bool = False):
+    """Update one document by id or filter; returns the number of modified documents (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    result = await async_db[collection_name].update_one(_id_filter(filter_or_id), _update_spec(update_data), upsert=upsert)
+    return result.modified_count
+
+async def delete_document_async(collection_name: str, filter_or_id):
+    """Delete one document by id or filter; returns the number of deleted documents (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    result = await async_db[collection_name].delete_one(_id_filter(filter_or_id))
+    return result.deleted_count
+
+async def get_documents_async(collection_name: str, filter_dict: dict = None, limit: int = None,
+                              projection: dict = None, sort: list = None, skip: int = None,
+                              batch_size: int = None):
+    """Get documents from collection (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = _find(async_db[collection_name], filter_dict, projection, sort, limit, skip, batch_size)
+    return await cursor.to_list(length=None)
+
+async def iter_documents_async(collection_name: str, filter_dict: dict = None, limit: int = None,
+                               projection: dict = None, sort: list = None, skip: int = None,
+                               batch_size: int = None):
+    """Yield documents lazily, fetching `batch_size` per round trip (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = _find(async_db[collection_name], filter_dict, projection, sort, limit, skip, batch_size)
+    try:
+        async for doc in cursor:
+            yield doc
+    finally:
+        # Motor's close() is a coroutine; it kills the server-side cursor when the consumer stops early
+        await cursor.close()
+
+async def get_page_async(collection_name: str, filter_dict: dict = None, page_size: int = 50,
+                         resume_token: str = None, projection: dict = None, descending: bool = False):
+    """Get one page of documents; returns (documents, next_resume_token or None) (async)"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    query, projection, sort = _page_query(filter_dict, resume_token, projection, descending)
+    docs = await _find(async_db[collection_name], query, projection, sort, page_size + 1).to_list(length=None)
+    return _page_result(docs, page_size)
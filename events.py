@@ -0,0 +1,160 @@
+"""
+Deal Events
+
+Status changes (an MOU signed, an invoice paid) are pushed to the UI over
+Server-Sent Events instead of being discovered by polling.
+
+EventBus is an in-process pub/sub keyed by deal id: each SSE connection holds one
+small queue and costs nothing while idle. The write endpoints call notify().
+
+With several worker processes, a write lands in one worker while the subscriber may
+be connected to another. With EVENTS_CHANGE_STREAM=1, ChangeStreamRelay watches the
+mou/invoice collections (replica set required) and publishes every status change to
+the local bus in each worker; notify() then leaves publishing to the relay so events
+are not delivered twice.
+"""
+
+import os
+import asyncio
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from tokens import TOKEN_FIELDS, from_stored
+
+logger = logging.getLogger(__name__)
+
+# Link prefix per collection, as in the deal snapshot
+_LINK_PREFIXES = {"mou": "/sign/", "invoice": "/invoice/"}
+
+def status_event(kind: str, deal_id: str, status: str, token: str = None) -> dict:
+    """Event payload for a `kind` document of `deal_id` reaching `status`"""
+    return {
+        "deal_id": str(deal_id),
+        "kind": kind,
+        "status": status,
+        "link": f"{_LINK_PREFIXES[kind]}{token}" if token else None,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+
+class EventBus:
+    """Per-deal fan-out to subscriber queues; meant to be used from the event loop thread only
+
+    A subscriber that falls `queue_size` events behind loses the oldest ones (counted in
+    `dropped`) rather than slowing down publishers.
+    """
+
+    def __init__(self, queue_size: int = 64):
+        self.queue_size = queue_size
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._subscribers = {}  # deal_id -> {asyncio.Queue}
+
+    def subscribe(self, deal_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(deal_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, deal_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(deal_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[deal_id]
+
+    @contextmanager
+    def subscription(self, deal_id: str):
+        queue = self.subscribe(deal_id)
+        try:
+            yield queue
+        finally:
+            self.unsubscribe(deal_id, queue)
+
+    def publish(self, deal_id: str, event: dict):
+        self.published += 1
+        for queue in self._subscribers.get(deal_id, ()):
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+            self.delivered += 1
+
+    def stats(self) -> dict:
+        return {
+            "deals": len(self._subscribers),
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+class ChangeStreamRelay:
+    """Publishes mou/invoice status changes made by any process to the local EventBus"""
+
+    def __init__(self, bus: EventBus, enabled: bool, retry_seconds: float = 5):
+        self.bus = bus
+        self.enabled = enabled
+        self.retry_seconds = retry_seconds
+        self.active = False
+        self.relayed = 0
+
+    def _pipeline(self) -> list:
+        return [
+            {"$match": {
+                "operationType": "update",
+                "ns.coll": {"$in": list(TOKEN_FIELDS)},
+                "updateDescription.updatedFields.status": {"$exists": True},
+            }},
+            {"$project": {
+                "ns.coll": 1,
+                "updateDescription.updatedFields.status": 1,
+                **{f"fullDocument.{field}": 1 for field in ("deal_id", *TOKEN_FIELDS.values())},
+            }},
+        ]
+
+    async def run(self, database):
+        """Background task: watch the database, resuming after errors, until cancelled"""
+        if not self.enabled or database is None:
+            return
+        resume_token = None
+        while True:
+            try:
+                async with database.watch(self._pipeline(), full_document="updateLookup",
+                                          resume_after=resume_token) as stream:
+                    self.active = True
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        self._relay(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Until the stream is back, writes in this process publish locally
+                self.active = False
+                logger.warning("Event change stream failed, retrying in %ss: %s", self.retry_seconds, e)
+                await asyncio.sleep(self.retry_seconds)
+
+    def _relay(self, change: dict):
+        kind = change["ns"]["coll"]
+        doc = change.get("fullDocument") or {}
+        if not doc.get("deal_id"):
+            return
+        status = change["updateDescription"]["updatedFields"]["status"]
+        token = from_stored(doc.get(TOKEN_FIELDS[kind]))
+        self.bus.publish(doc["deal_id"], status_event(kind, doc["deal_id"], status, token))
+        self.relayed += 1
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "active": self.active, "relayed": self.relayed}
+
+event_bus = EventBus(queue_size=int(os.getenv("EVENTS_QUEUE_SIZE", "64")))
+
+change_stream_relay = ChangeStreamRelay(
+    event_bus,
+    enabled=os.getenv("EVENTS_CHANGE_STREAM", "0") in ("1", "true", "True"),
+)
+
+def notify(deal_id: str, event: dict):
+    """Publish a status change made by this process (unless the change stream relays it)"""
+    if not change_stream_relay.active:
+        event_bus.publish(str(deal_id), event)
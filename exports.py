@@ -0,0 +1,111 @@
+"""
+Collection Exports
+
+Streams deals, MOUs, invoices and receipts out as CSV or NDJSON for
+GET /api/export/{collection}. Documents are read from a batched cursor and
+written out in chunks of about EXPORT_CHUNK_BYTES, so memory use does not grow
+with the size of the collection.
+
+Exports hold every client's details, so the endpoint only answers requests
+carrying EXPORT_API_KEY in an X-Export-Key header (and is off while it is unset).
+Client tokens, the only thing guarding the sign and paid links, are never exported.
+"""
+
+import io
+import csv
+import os
+import hmac
+from datetime import datetime
+
+from bson import ObjectId
+
+from database import iter_documents_async
+from responses import dumps
+from schemas import Deal, Mou, Invoice, Receipt
+from tokens import STORED_TOKEN_FIELDS
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(64 * 1024)))
+
+EXPORT_MODELS = {"deal": Deal, "mou": Mou, "invoice": Invoice, "receipt": Receipt}
+
+# Field the `client` filter matches in each collection
+CLIENT_FIELDS = {"deal": "client_name", "invoice": "client_name", "receipt": "client_name"}
+
+def _mou_client(client: str) -> dict:
+    """MOUs name their client as create_mou does: client_details.client_name, else client_details.name"""
+    return {"$or": [
+        {"client_details.client_name": client},
+        {"client_details.client_name": {"$in": [None, ""]}, "client_details.name": client},
+    ]}
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+EXPORT_API_KEY = os.getenv("EXPORT_API_KEY", "")
+
+def authorized(key: str) -> bool:
+    """Whether `key` (the X-Export-Key header) is the configured EXPORT_API_KEY"""
+    return bool(EXPORT_API_KEY and key) and hmac.compare_digest(key.encode(), EXPORT_API_KEY.encode())
+
+def columns(collection_name: str) -> list:
+    """CSV header: _id, the schema fields but the tokens, then the timestamps every document carries"""
+    fields = [name for name in EXPORT_MODELS[collection_name].model_fields if name not in STORED_TOKEN_FIELDS]
+    return ["_id", *fields, "created_at", "updated_at"]
+
+def export_filter(collection_name: str, since: datetime = None, until: datetime = None,
+                  status: str = None, client: str = None) -> dict:
+    """MongoDB filter for the export parameters
+
+    The date range is applied to _id (ObjectIds embed their creation time), so it is
+    served by the _id index the export is sorted on.
+    """
+    query = {}
+    if since or until:
+        query["_id"] = {}
+        if since:
+            query["_id"]["$gte"] = ObjectId.from_datetime(since)
+        if until:
+            query["_id"]["$lt"] = ObjectId.from_datetime(until)
+    if status:
+        query["status"] = status
+    if client:
+        if collection_name == "mou":
+            query.update(_mou_client(client))
+        else:
+            query[CLIENT_FIELDS[collection_name]] = client
+    return query
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return dumps(value).decode()
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def export_rows(collection_name: str, query: dict, fmt: str):
+    """Yield the export as byte chunks"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    names = columns(collection_name)
+    if fmt == "csv":
+        writer.writerow(names)
+    chunk = bytearray()
+    exclude = dict.fromkeys(STORED_TOKEN_FIELDS, 0)
+    async for doc in iter_documents_async(collection_name, query, projection=exclude, sort=[("_id", 1)],
+                                          batch_size=EXPORT_BATCH_SIZE):
+        if fmt == "csv":
+            writer.writerow([_cell(doc.get(name)) for name in names])
+        else:
+            chunk += dumps(doc) + b"\n"
+        if buffer.tell():
+            chunk += buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        if len(chunk) >= EXPORT_CHUNK_BYTES:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += buffer.getvalue().encode()
+    if chunk:
+        yield bytes(chunk)
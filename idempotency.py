@@ -0,0 +1,193 @@
+"""
+Idempotency-Key Support
+
+A POST carrying an `Idempotency-Key` header runs its handler at most once: the
+response is stored under the key, and a retry with the same key gets the stored
+response back (marked `Idempotent-Replayed: true`) without the handler running again.
+
+Keys live in the `idempotency` collection, which a TTL index empties after
+IDEMPOTENCY_TTL_SECONDS, behind a per-process TTLCache of completed responses.
+A key is claimed before the handler runs:
+- a retry that arrives while the first request is still running gets 409
+- a key reused with a different method, path or body gets 422
+- 5xx responses are not stored, and the claim is released so the client may retry
+- a claim older than IDEMPOTENCY_PENDING_SECONDS (a crashed worker) can be taken over
+"""
+
+import os
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import database
+from cache import TTLCache
+from responses import dumps
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_PENDING_SECONDS = float(os.getenv("IDEMPOTENCY_PENDING_SECONDS", "60"))
+# Responses larger than this (streamed exports and the like) are not stored
+IDEMPOTENCY_MAX_BODY_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BODY_BYTES", str(1024 * 1024)))
+_MAX_KEY_LENGTH = 255
+
+class IdempotencyStore:
+    """Claims keys and stores/loads completed responses (status, headers, body)"""
+
+    def __init__(self, cache: TTLCache):
+        self.cache = cache
+        self.stored = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.mismatches = 0
+
+    @property
+    def collection(self):
+        return database.async_db["idempotency"]
+
+    async def claim(self, key: str, fingerprint: str):
+        """None if the key is now ours; otherwise the existing record ("pending" or "done")"""
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        now = datetime.now(timezone.utc)
+        try:
+            await self.collection.insert_one(
+                {"_id": key, "fingerprint": fingerprint, "state": "pending", "created_at": now, "claimed_at": now}
+            )
+            return None
+        except DuplicateKeyError:
+            pass
+        record = await self.collection.find_one({"_id": key})
+        if record is None:
+            # Expired between the insert and the read
+            return await self.claim(key, fingerprint)
+        if record["state"] == "pending" and record["fingerprint"] == fingerprint:
+            # Take over a claim whose request never finished
+            stale = now - timedelta(seconds=IDEMPOTENCY_PENDING_SECONDS)
+            result = await self.collection.update_one(
+                {"_id": key, "state": "pending", "claimed_at": {"$lt": stale}},
+                {"$set": {"claimed_at": now}},
+            )
+            if result.modified_count:
+                return None
+        if record["state"] == "done":
+            self.cache.set(key, record)
+        return record
+
+    async def complete(self, key: str, fingerprint: str, status: int, headers: list, body: bytes):
+        record = {"state": "done", "status": status, "headers": headers, "body": Binary(body)}
+        await self.collection.update_one({"_id": key}, {"$set": record})
+        self.stored += 1
+        self.cache.set(key, {"_id": key, "fingerprint": fingerprint, **record})
+
+    async def release(self, key: str):
+        """Drop our claim so a retry runs the handler again"""
+        try:
+            await self.collection.delete_one({"_id": key, "state": "pending"})
+        except PyMongoError as e:
+            logger.warning("Could not release Idempotency-Key %s: %s", key, e)
+
+    def stats(self) -> dict:
+        return {
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+            "mismatches": self.mismatches,
+            "cache": self.cache.stats(),
+        }
+
+idempotency_store = IdempotencyStore(TTLCache(
+    max_bytes=int(os.getenv("IDEMPOTENCY_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),
+    ttl=float(os.getenv("IDEMPOTENCY_CACHE_TTL_SECONDS", "600")),
+))
+
+async def _send_json(send, status: int, payload: dict, headers: list = ()):
+    body = dumps(payload)
+    await send({"type": "http.response.start", "status": status, "headers": [
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers,
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+class IdempotencyMiddleware:
+    """Pure ASGI middleware applying Idempotency-Key semantics to POST requests"""
+
+    def __init__(self, app, store: IdempotencyStore = idempotency_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or database.async_db is None:
+            return await self.app(scope, receive, send)
+        key = dict(scope["headers"]).get(b"idempotency-key")
+        if key is None:
+            return await self.app(scope, receive, send)
+        key = key.decode("latin-1")
+        if not key or len(key) > _MAX_KEY_LENGTH:
+            return await _send_json(send, 400, {"detail": f"Idempotency-Key must be 1-{_MAX_KEY_LENGTH} characters"})
+
+        # The body is part of the fingerprint, so it is read here and replayed to the app
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        body = b"".join(chunks)
+        fingerprint = hashlib.sha256(
+            b"\0".join((scope["method"].encode(), scope["path"].encode(), scope["query_string"], body))
+        ).hexdigest()
+
+        record = await self.store.claim(key, fingerprint)
+        if record is not None:
+            if record["fingerprint"] != fingerprint:
+                self.store.mismatches += 1
+                return await _send_json(send, 422, {"detail": "Idempotency-Key was used for a different request"})
+            if record["state"] != "done":
+                self.store.conflicts += 1
+                return await _send_json(send, 409, {"detail": "A request with this Idempotency-Key is in progress"},
+                                        [(b"retry-after", b"1")])
+            self.store.replayed += 1
+            headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in record["headers"]]
+            await send({"type": "http.response.start", "status": record["status"],
+                        "headers": headers + [(b"idempotent-replayed", b"true")]})
+            await send({"type": "http.response.body", "body": bytes(record["body"])})
+            return
+
+        body_sent = False
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"status": 500, "headers": [], "body": bytearray(), "storable": True}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = [
+                    (name.decode("latin-1"), value.decode("latin-1")) for name, value in message.get("headers", [])
+                ]
+            elif message["type"] == "http.response.body" and response["storable"]:
+                response["body"] += message.get("body", b"")
+                if len(response["body"]) > IDEMPOTENCY_MAX_BODY_BYTES:
+                    response["storable"] = False
+                    response["body"] = bytearray()
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await self.store.release(key)
+            raise
+        if response["status"] >= 500 or not response["storable"]:
+            await self.store.release(key)
+        else:
+            await self.store.complete(key, fingerprint, response["status"], response["headers"], bytes(response["body"]))
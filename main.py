@@ -1,19 +1,62 @@
 import os
+import asyncio
 import io
 import base64
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
-from fastapi import FastAPI, HTTPException
+from typing import Optional, List
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
-from uuid import uuid4
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
-from database import db, create_document, get_documents
+from pymongo import ReturnDocument
+import database
+from database import (
+    create_document_async, get_or_create_document_async, ensure_indexes_async,
+    run_in_transaction_async,
+)
 from schemas import Deal, Mou, Invoice, Receipt
+from cache import TTLCache, SingleFlight, approximate_size
+from responses import ORJSONResponse, dumps, bson_to_json
+from tokens import token_filter, token_query, issue_token, is_signed, store_tokens, load_tokens, from_stored
+from idempotency import IdempotencyMiddleware, idempotency_store
+from exports import EXPORT_MODELS, FORMATS, authorized, export_filter, export_rows
+from events import event_bus, change_stream_relay, notify, status_event
+from snapshots import snapshot_pipeline, build_snapshot, from_materialized, initial_snapshot, snapshot_update
+
+# Strong references to fire-and-forget startup tasks so they are not garbage collected
+_background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fails startup if MongoDB is configured but unreachable; pre-warms the pool before serving
+    async_db = await database.open_async()
+    # Index builds and the token filter load run in the background so startup is not held up on large collections
+    run_in_background(ensure_indexes_async())
+    run_in_background(token_filter.run(async_db))
+    run_in_background(change_stream_relay.run(async_db))
+    try:
+        yield
+    finally:
+        for task in list(_background_tasks):
+            task.cancel()
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await database.close_async()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
+# Inside CORS, so replayed responses get CORS headers too
+app.add_middleware(IdempotencyMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -23,11 +66,16 @@ app.add_middleware(
 )
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Deal Admin Hub Backend"}
 
+@app.get("/healthz")
+async def healthz():
+    # Liveness of the worker that takes the connection; answered from the event loop, so a blocked loop fails it
+    return {"status": "ok", "pid": os.getpid(), "database": database.async_db is not None}
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -37,10 +85,10 @@ def test_database():
         "collections": []
     }
     try:
-        if db is not None:
+        if database.async_db is not None:
             response["database"] = "✅ Available"
             try:
-                collections = db.list_collection_names()
+                collections = await database.async_db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -52,6 +100,18 @@ def test_database():
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
     return response
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "token_cache": token_cache.stats(),
+        "token_filter": token_filter.stats(),
+        "deal_cache": deal_cache.stats(),
+        "read_coalescing": read_flights.stats(),
+        "idempotency": idempotency_store.stats(),
+        "mongo_pool_wait": database.pool_wait.stats(),
+        "events": {**event_bus.stats(), "change_stream": change_stream_relay.stats()},
+    }
+
 # --------- Models for requests ---------
 class CreateMouRequest(BaseModel):
     my_details: dict
@@ -82,132 +142,451 @@ class MarkPaidRequest(BaseModel):
     amount_received: float
     payment_reference: str
 
+class DealPair(BaseModel):
+    client_name: str
+    project_name: str
+
+class SnapshotsRequest(BaseModel):
+    pairs: Optional[List[DealPair]] = None
+    status: Optional[str] = None
+    fields: Optional[List[str]] = None
+
 # Utility
 
+# Read-through cache for the public token documents, keyed by (kind, token, fields) and tagged (kind, token),
+# so full and field-selected responses are cached separately and a write drops them all.
+# Local writes invalidate entries; the TTL bounds staleness from writes made by other processes.
+# Values are (etag, document or encoded bytes).
+token_cache = TTLCache(
+    max_bytes=int(os.getenv("TOKEN_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "30")),
+    sizeof=lambda entry: approximate_size(entry[1]),
+)
+
+# (client_name, project_name) -> deal_id. A deal's identity never changes, so a hit skips
+# the deal query entirely; the TTL only bounds memory held by deals that are no longer used.
+# `manage.py dedupe-deals` does delete deals, so attach_to_deal() confirms a cached id before use.
+deal_cache = TTLCache(
+    max_bytes=int(os.getenv("DEAL_CACHE_MAX_BYTES", str(4 * 1024 * 1024))),
+    ttl=float(os.getenv("DEAL_CACHE_TTL_SECONDS", "3600")),
+)
+
+# Concurrent identical reads (token documents, snapshots) share one in-flight MongoDB call
+read_flights = SingleFlight()
+
+def invalidate_token(kind: str, token: str):
+    """After a write to a token document: drop its cached responses and stop sharing reads already in flight"""
+    token_cache.invalidate_tag((kind, token))
+    read_flights.forget_tag((kind, token))
+
+def invalidate_snapshot(deal_key: Optional[tuple]):
+    """After a committed snapshot change of the (client_name, project_name) deal: stop sharing reads in flight"""
+    if deal_key is not None:
+        read_flights.forget_tag(("snapshot", *deal_key))
+
 def collection(name: str):
-    return db[name]
+    return database.async_db[name]
+
+# --------- Field selection (?fields=) ---------
+
+# Fields every stored document carries besides its schema fields (see database._prepare_document)
+DOCUMENT_FIELDS = frozenset({"_id", "created_at", "updated_at"})
+SELECTABLE_FIELDS = {
+    "mou": frozenset(Mou.model_fields) | DOCUMENT_FIELDS,
+    "invoice": frozenset(Invoice.model_fields) | DOCUMENT_FIELDS,
+    "snapshot": frozenset({"client_name", "project_name", "mou", "invoice", "receipt_available", "next_step"}),
+}
+
+def parse_fields(fields, kind: str) -> Optional[tuple]:
+    """Validated field selection (comma-separated string or list) as a sorted tuple; None selects everything"""
+    if fields is None:
+        return None
+    names = fields.split(",") if isinstance(fields, str) else fields
+    selected = {name.strip() for name in names if name.strip()}
+    if not selected:
+        return None
+    unknown = selected - SELECTABLE_FIELDS[kind]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields for {kind}: {', '.join(sorted(unknown))}")
+    return tuple(sorted(selected))
+
+def field_projection(fields: Optional[tuple]) -> Optional[dict]:
+    """MongoDB projection for a field selection (_id only when selected)"""
+    if fields is None:
+        return None
+    projection = dict.fromkeys(fields, 1)
+    projection.setdefault("_id", 0)
+    return projection
+
+# Opt-in: transcode token documents from raw BSON straight to JSON instead of decoding them to dicts.
+# The token cache then holds the encoded bytes.
+RAW_BSON_RESPONSES = os.getenv("RAW_BSON_RESPONSES", "0") in ("1", "true", "True")
+_RAW_BSON = CodecOptions(document_class=RawBSONDocument)
+
+def token_etag(kind: str, version: int) -> str:
+    """Strong ETag of a token document representation (the URL already names the token and fields)"""
+    return f'"{kind}.{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match check; weak comparison, as RFC 9110 specifies for this header"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+def token_response(content, etag: str, if_none_match: Optional[str] = None) -> Response:
+    """200 with `content` (encoded bytes or a document), or 304 when the client already has `etag`"""
+    # no-cache: clients may store the document but must revalidate, which is what 304s make cheap
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    if isinstance(content, bytes):
+        return Response(content, media_type="application/json", headers=headers)
+    return ORJSONResponse(content, headers=headers)
+
+async def fetch_token_document(kind: str, query: dict, fields: Optional[tuple]):
+    """(etag, content) for the document matching `query`, or None; content is bytes on the raw BSON path"""
+    projection = field_projection(fields)
+    # The version is always read for the ETag, but only returned when selected
+    hide_version = fields is not None and "version" not in fields
+    if hide_version:
+        projection["version"] = 1
+
+    if RAW_BSON_RESPONSES:
+        raw = await collection(kind).with_options(codec_options=_RAW_BSON).find_one(query, projection)
+        if raw is None:
+            return None
+        version = raw.get("version", 0)
+        try:
+            content = bson_to_json(raw.raw, binary=from_stored, exclude=("version",) if hide_version else ())
+        except TypeError:
+            # A BSON type the transcoder does not handle: take the decoding path for this document
+            doc = load_tokens(bson.decode(raw.raw))
+            if hide_version:
+                doc.pop("version", None)
+            content = dumps(doc)
+    else:
+        content = await collection(kind).find_one(query, projection)
+        if content is None:
+            return None
+        version = content.pop("version", 0) if hide_version else content.get("version", 0)
+        load_tokens(content)
+    return token_etag(kind, version), content
+
+async def token_document(kind: str, token: str, not_found: str, fields: Optional[tuple] = None,
+                         if_none_match: Optional[str] = None) -> Response:
+    """Response with the `kind` document (or its selected `fields`) behind a client token
+
+    Served from token_cache when possible; otherwise the selection is pushed down as a
+    projection, and concurrent misses for the same token and fields share one query.
+    A conditional request that misses the cache first reads only the document's
+    version, and gets a 304 without the document being read if it is current.
+    """
+    cache_key = (kind, token, fields)
+    cached = token_cache.get(cache_key)
+    if cached is not None:
+        etag, content = cached
+        return token_response(content, etag, if_none_match)
+    query = await token_query(kind, token)
+    if query is None:
+        raise HTTPException(status_code=404, detail=not_found)
+
+    if if_none_match:
+        current = await read_flights.do(
+            ("version", kind, token), lambda: collection(kind).find_one(query, {"version": 1, "_id": 0}),
+            tag=(kind, token),
+        )
+        if current is None:
+            raise HTTPException(status_code=404, detail=not_found)
+        etag = token_etag(kind, current.get("version", 0))
+        if etag_matches(if_none_match, etag):
+            return token_response(None, etag, if_none_match)
+
+    async def fetch():
+        # A write that lands while we read invalidates the tag, and set() then drops our entry
+        generation = token_cache.generation((kind, token))
+        entry = await fetch_token_document(kind, query, fields)
+        if entry is not None:
+            token_cache.set(cache_key, entry, tag=(kind, token), generation=generation)
+        return entry
+
+    entry = await read_flights.do(("document", *cache_key), fetch, tag=(kind, token))
+    if entry is None:
+        raise HTTPException(status_code=404, detail=not_found)
+    etag, content = entry
+    return token_response(content, etag, if_none_match)
+
+async def resolve_deal(deal: Deal, session=None) -> tuple:
+    """(deal_id, created) for the deal's client+project, inserting `deal` if there is none
+
+    One upsert against the unique (client_name, project_name) index, so concurrent
+    requests for a new client share a single deal.
+    """
+    key = (deal.client_name, deal.project_name)
+    deal_id = deal_cache.get(key)
+    if deal_id is not None:
+        return deal_id, False
+    deal_id, created = await get_or_create_document_async(
+        "deal", {"client_name": deal.client_name, "project_name": deal.project_name}, deal, session=session
+    )
+    # A deal created inside a transaction only exists once it commits
+    if session is None or not created:
+        deal_cache.set(key, deal_id)
+    return deal_id, created
+
+async def update_snapshot(deal_id: str, condition: dict, fields: dict, session=None) -> Optional[tuple]:
+    """Apply `fields` to the deal's materialized snapshot if `condition` still holds
+
+    Returns the deal's (client_name, project_name), or None if no deal matched.
+    """
+    if not ObjectId.is_valid(deal_id):
+        return None
+    deal = await collection("deal").find_one_and_update(
+        {"_id": ObjectId(deal_id), **condition}, snapshot_update(fields),
+        projection={"_id": 0, "client_name": 1, "project_name": 1}, session=session,
+    )
+    return (deal.get("client_name"), deal.get("project_name")) if deal is not None else None
+
+async def attach_to_deal(deal: Deal, snapshot_fields: dict, session=None) -> str:
+    """Deal id for a new MOU/invoice of `deal`, with `snapshot_fields` applied to the deal's snapshot
+
+    A new deal stores its snapshot in the upsert. A known deal's snapshot is updated before
+    the document is inserted, which also confirms a cached id: if the update matches nothing
+    and the deal is gone (removed by `manage.py dedupe-deals`), the deal is resolved again.
+    """
+    key = (deal.client_name, deal.project_name)
+    while True:
+        cached = key in deal_cache
+        deal_id, created = await resolve_deal(deal, session=session)
+        if created or await update_snapshot(deal_id, {"snapshot": {"$exists": True}}, snapshot_fields,
+                                            session=session):
+            return deal_id
+        # No match: a deal written before snapshots were materialized, or a removed one
+        if not cached or await collection("deal").find_one({"_id": ObjectId(deal_id)}, {"_id": 1},
+                                                           session=session):
+            return deal_id
+        deal_cache.invalidate(key)
+
+async def read_snapshot(deal: dict) -> dict:
+    if deal.get("snapshot"):
+        return from_materialized(deal)
+    # Deal written before snapshots were materialized: compute it from the source collections
+    docs = await collection("deal").aggregate(snapshot_pipeline({"_id": deal["_id"]})).to_list(length=1)
+    return build_snapshot(docs[0])
+
+_DEAL_FIELDS = ("client_name", "project_name")
+
+def snapshot_projection(fields: Optional[tuple]) -> dict:
+    """Deal projection covering a snapshot field selection"""
+    if fields is None:
+        return {"client_name": 1, "project_name": 1, "snapshot": 1}
+    return {name if name in _DEAL_FIELDS else f"snapshot.{name}": 1 for name in fields}
+
+def pick_fields(snapshot: dict, fields: Optional[tuple]) -> dict:
+    return snapshot if fields is None else {name: snapshot.get(name) for name in fields}
+
+def needs_snapshot(fields: Optional[tuple]) -> bool:
+    """Whether a selection reads anything beyond the deal's own fields"""
+    return fields is None or bool(set(fields) - set(_DEAL_FIELDS))
+
+async def select_snapshot(deal: dict, fields: Optional[tuple]) -> dict:
+    """Snapshot response for a deal fetched with snapshot_projection(fields)"""
+    return pick_fields(await read_snapshot(deal) if needs_snapshot(fields) else deal, fields)
 
 # --------- MOU endpoints ---------
 @app.post("/api/mou")
-def create_mou(payload: CreateMouRequest):
-    token = uuid4().hex
+async def create_mou(payload: CreateMouRequest):
+    token, mou_document_id = issue_token("mou")
+    if not is_signed(token):
+        token_filter.add("mou", token)
     deal = Deal(
         client_name=payload.client_details.get("client_name") or payload.client_details.get("name", ""),
         client_company=payload.client_details.get("company"),
         client_contact=payload.client_details.get("contact"),
         project_name=payload.project.get("name", ""),
         project_description=payload.project.get("description"),
+        snapshot=initial_snapshot(mou={"status": "sent", "sign_token": token}),
     )
-    deal_id = create_document("deal", deal)
-
-    mou = Mou(
-        deal_id=deal_id,
-        my_details=payload.my_details,
-        client_details=payload.client_details,
-        project=payload.project,
-        terms=payload.terms,
-        status="sent",
-        sign_token=token,
-    )
-    mou_id = create_document("mou", mou)
+    # Allocated client-side so a retried transaction re-inserts the same MOU
+    mou_document_id = mou_document_id or ObjectId()
+
+    async def write(session):
+        # Known deal (cache hit): no deal query at all. New deal: the upsert stores its snapshot.
+        deal_id = await attach_to_deal(deal, {"mou": {"status": "Sent", "link": f"/sign/{token}"}}, session=session)
+        mou = Mou(
+            deal_id=deal_id,
+            my_details=payload.my_details,
+            client_details=payload.client_details,
+            project=payload.project,
+            terms=payload.terms,
+            status="sent",
+            sign_token=token,
+        )
+        return await create_document_async("mou", store_tokens(mou), document_id=mou_document_id, session=session)
 
+    mou_id = await run_in_transaction_async(write)
+    invalidate_snapshot((deal.client_name, deal.project_name))
     return {"mou_id": mou_id, "sign_url_token": token}
 
 @app.get("/api/mou/{token}")
-def get_mou_by_token(token: str):
-    doc = collection("mou").find_one({"sign_token": token})
-    if not doc:
-        raise HTTPException(status_code=404, detail="MOU not found")
-    doc["_id"] = str(doc["_id"])
-    return doc
+async def get_mou_by_token(token: str, fields: Optional[str] = None, if_none_match: Optional[str] = Header(None)):
+    return await token_document("mou", token, "MOU not found", parse_fields(fields, "mou"), if_none_match)
 
 @app.post("/api/mou/{token}/sign")
-def sign_mou(token: str, payload: SignMouRequest):
+async def sign_mou(token: str, payload: SignMouRequest):
     if not payload.agree:
         raise HTTPException(status_code=400, detail="Agreement checkbox is required")
-    result = collection("mou").find_one_and_update(
-        {"sign_token": token},
-        {"$set": {
-            "status": "signed",
-            "client_signature_name": payload.name,
-            "client_signature_title": payload.title,
-            "signed_at": datetime.utcnow().isoformat()
-        }},
-        return_document=True
-    )
-    if not result:
+    query = await token_query("mou", token)
+    if query is None:
         raise HTTPException(status_code=404, detail="MOU not found")
+
+    async def write(session):
+        result = await collection("mou").find_one_and_update(
+            query,
+            {"$set": {
+                "status": "signed",
+                "client_signature_name": payload.name,
+                "client_signature_title": payload.title,
+                "signed_at": datetime.utcnow().isoformat()
+            }, "$inc": {"version": 1}},
+            projection={"deal_id": 1},
+            return_document=True,
+            session=session,
+        )
+        if not result:
+            raise HTTPException(status_code=404, detail="MOU not found")
+        # Only when this is still the deal's latest MOU
+        deal_key = await update_snapshot(result["deal_id"], {"snapshot.mou.link": f"/sign/{token}"},
+                                         {"mou.status": "Signed"}, session=session)
+        return result["deal_id"], deal_key
+
+    deal_id, deal_key = await run_in_transaction_async(write)
+    invalidate_token("mou", token)
+    invalidate_snapshot(deal_key)
+    notify(deal_id, status_event("mou", deal_id, "signed", token))
     return {"status": "signed"}
 
 # --------- Invoice endpoints ---------
 @app.post("/api/invoice")
-def create_invoice(payload: CreateInvoiceRequest):
-    token = uuid4().hex
-    # find (or create) deal for client+project
-    deal = collection("deal").find_one({
-        "client_name": payload.client_name,
-        "project_name": payload.project_name,
-    })
-    if not deal:
-        d = Deal(client_name=payload.client_name, project_name=payload.project_name)
-        deal_id = create_document("deal", d)
-    else:
-        deal_id = str(deal["_id"])
-
-    inv = Invoice(
-        deal_id=deal_id,
-        my_details=payload.my_details,
+async def create_invoice(payload: CreateInvoiceRequest):
+    token, invoice_document_id = issue_token("invoice")
+    if not is_signed(token):
+        token_filter.add("invoice", token)
+    deal = Deal(
         client_name=payload.client_name,
         project_name=payload.project_name,
-        invoice_number=payload.invoice_number,
-        invoice_date=payload.invoice_date,
-        due_date=payload.due_date,
-        amount=payload.amount,
-        currency=payload.currency,
-        bank_details=payload.bank_details,
-        payment_reference=payload.payment_reference,
-        status="sent",
-        view_token=token,
+        snapshot=initial_snapshot(invoice={"status": "sent", "view_token": token}),
     )
-    inv_id = create_document("invoice", inv)
+    # Allocated client-side so a retried transaction re-inserts the same invoice
+    invoice_document_id = invoice_document_id or ObjectId()
+
+    async def write(session):
+        # find (or create) deal for client+project
+        deal_id = await attach_to_deal(deal, {
+            "invoice": {"status": "Sent", "link": f"/invoice/{token}"},
+            "receipt_available": False,
+        }, session=session)
+        inv = Invoice(
+            deal_id=deal_id,
+            my_details=payload.my_details,
+            client_name=payload.client_name,
+            project_name=payload.project_name,
+            invoice_number=payload.invoice_number,
+            invoice_date=payload.invoice_date,
+            due_date=payload.due_date,
+            amount=payload.amount,
+            currency=payload.currency,
+            bank_details=payload.bank_details,
+            payment_reference=payload.payment_reference,
+            status="sent",
+            view_token=token,
+        )
+        return await create_document_async("invoice", store_tokens(inv), document_id=invoice_document_id,
+                                           session=session)
+
+    inv_id = await run_in_transaction_async(write)
+    invalidate_snapshot((deal.client_name, deal.project_name))
     return {"invoice_id": inv_id, "view_url_token": token}
 
 @app.get("/api/invoice/{token}")
-def get_invoice_by_token(token: str):
-    doc = collection("invoice").find_one({"view_token": token})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Invoice not found")
-    doc["_id"] = str(doc["_id"])
-    return doc
+async def get_invoice_by_token(token: str, fields: Optional[str] = None,
+                               if_none_match: Optional[str] = Header(None)):
+    return await token_document("invoice", token, "Invoice not found", parse_fields(fields, "invoice"),
+                                if_none_match)
 
 @app.post("/api/invoice/{token}/paid")
-def mark_invoice_paid(token: str, payload: MarkPaidRequest):
-    doc = collection("invoice").find_one({"view_token": token})
-    if not doc:
+async def mark_invoice_paid(token: str, payload: MarkPaidRequest):
+    query = await token_query("invoice", token)
+    if query is None:
         raise HTTPException(status_code=404, detail="Invoice not found")
 
     payment_date = payload.payment_date or datetime.utcnow().date().isoformat()
-    collection("invoice").update_one({"view_token": token}, {"$set": {
-        "status": "paid",
-        "paid_at": payment_date,
-        "payment_method": payload.payment_method,
-        "amount_received": payload.amount_received,
-    }})
-
-    receipt = Receipt(
-        invoice_token=token,
-        deal_id=str(doc["deal_id"]),
-        my_details=doc["my_details"],
-        client_name=doc["client_name"],
-        project_name=doc["project_name"],
-        invoice_number=doc["invoice_number"],
-        original_amount=doc["amount"],
-        amount_paid=payload.amount_received,
-        payment_date=payment_date,
-        payment_method=payload.payment_method,
-        payment_reference=payload.payment_reference,
-    )
-    receipt_id = create_document("receipt", receipt)
+    receipt_fields = {
+        "view_token": 1, "deal_id": 1, "my_details": 1, "client_name": 1,
+        "project_name": 1, "invoice_number": 1, "amount": 1,
+    }
+
+    async def write(session):
+        # Mark paid only if not paid yet; the pre-image tells us whether this request made the transition
+        doc = await collection("invoice").find_one_and_update(
+            {**query, "status": {"$ne": "paid"}},
+            {"$set": {
+                "status": "paid",
+                "paid_at": payment_date,
+                "payment_method": payload.payment_method,
+                "amount_received": payload.amount_received,
+            }, "$inc": {"version": 1}},
+            projection=receipt_fields,
+            return_document=ReturnDocument.BEFORE,
+            session=session,
+        )
+        first_payment = doc is not None
+        if not first_payment:
+            # Retry or concurrent duplicate: the invoice is already paid (or does not exist)
+            doc = await collection("invoice").find_one(query, receipt_fields, session=session)
+            if not doc:
+                raise HTTPException(status_code=404, detail="Invoice not found")
+
+        receipt = Receipt(
+            invoice_token=token,
+            deal_id=str(doc["deal_id"]),
+            my_details=doc["my_details"],
+            client_name=doc["client_name"],
+            project_name=doc["project_name"],
+            invoice_number=doc["invoice_number"],
+            original_amount=doc["amount"],
+            amount_paid=payload.amount_received,
+            payment_date=payment_date,
+            payment_method=payload.payment_method,
+            payment_reference=payload.payment_reference,
+        )
+        # Exactly one receipt per invoice, keyed by the token in the form the invoice stores it
+        # (so the snapshot $lookup matches); duplicates get the existing receipt's id
+        create_receipt = get_or_create_document_async(
+            "receipt", {"invoice_token": doc["view_token"]}, receipt.model_dump(exclude={"invoice_token"}),
+            session=session,
+        )
+        if not first_payment:
+            receipt_id, _ = await create_receipt
+            return receipt_id, doc["deal_id"], False, None
+        snapshot_write = update_snapshot(
+            doc["deal_id"], {"snapshot.invoice.link": f"/invoice/{token}"},
+            {"invoice.status": "Paid", "receipt_available": True}, session=session,
+        )
+        if session is not None:
+            # Operations in one session must not overlap
+            receipt_id, _ = await create_receipt
+            deal_key = await snapshot_write
+        else:
+            (receipt_id, _), deal_key = await asyncio.gather(create_receipt, snapshot_write)
+        return receipt_id, doc["deal_id"], True, deal_key
+
+    receipt_id, deal_id, first_payment, deal_key = await run_in_transaction_async(write)
+    if first_payment:
+        invalidate_token("invoice", token)
+        invalidate_snapshot(deal_key)
+        notify(deal_id, status_event("invoice", deal_id, "paid", token))
     return {"status": "paid", "receipt_id": receipt_id}
 
 # --------- Simple PDFs (HTML to PDF via browser print) ---------
@@ -215,51 +594,98 @@ def mark_invoice_paid(token: str, payload: MarkPaidRequest):
 
 # --------- Snapshot endpoint ---------
 @app.get("/api/deal/snapshot")
-def deal_snapshot(client_name: str, project_name: str):
-    deal = collection("deal").find_one({"client_name": client_name, "project_name": project_name})
-    if not deal:
+async def deal_snapshot(client_name: str, project_name: str, fields: Optional[str] = None):
+    fields = parse_fields(fields, "snapshot")
+
+    async def fetch():
+        # The snapshot is materialized on the deal, so this is one indexed find_one
+        deal = await collection("deal").find_one(
+            {"client_name": client_name, "project_name": project_name},
+            snapshot_projection(fields),
+        )
+        return await select_snapshot(deal, fields) if deal else None
+
+    snapshot = await read_flights.do(("snapshot", client_name, project_name, fields), fetch,
+                                     tag=("snapshot", client_name, project_name))
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="Deal not found")
-    deal_id = str(deal["_id"]) if "_id" in deal else deal.get("id", "")
-
-    mou = collection("mou").find_one({"deal_id": deal_id}, sort=[("created_at", -1)])
-    invoice = collection("invoice").find_one({"deal_id": deal_id}, sort=[("created_at", -1)])
-    receipt = None
-    if invoice:
-        receipt = collection("receipt").find_one({"invoice_token": invoice.get("view_token")}, sort=[("created_at", -1)])
-
-    def mou_status():
-        if not mou:
-            return {"status": "Draft", "link": None}
-        status = mou.get("status", "draft").capitalize()
-        link = f"/sign/{mou.get('sign_token')}" if mou.get("sign_token") else None
-        return {"status": status, "link": link}
-
-    def invoice_status():
-        if not invoice:
-            return {"status": "Draft", "link": None}
-        status = invoice.get("status", "draft").capitalize()
-        link = f"/invoice/{invoice.get('view_token')}" if invoice.get("view_token") else None
-        return {"status": status, "link": link}
-
-    # Next step hint
-    hint = ""
-    ms = mou_status()["status"].lower()
-    ins = invoice_status()["status"].lower()
-    if ms == "draft":
-        hint = "Next: Generate sign link and send to client."
-    elif ms == "signed" and ins == "draft":
-        hint = "Next: Generate invoice and send."
-    elif ins == "paid" and not receipt:
-        hint = "Next: Generate receipt and send."
+    return ORJSONResponse(snapshot)
 
-    return {
-        "client_name": client_name,
-        "project_name": project_name,
-        "mou": mou_status(),
-        "invoice": invoice_status(),
-        "receipt_available": True if receipt else False,
-        "next_step": hint
-    }
+@app.post("/api/deal/snapshots")
+async def deal_snapshots(payload: SnapshotsRequest):
+    match = {}
+    if payload.pairs:
+        match["$or"] = [{"client_name": p.client_name, "project_name": p.project_name} for p in payload.pairs]
+    if payload.status:
+        match["status"] = payload.status
+    if not match:
+        raise HTTPException(status_code=400, detail="Provide pairs or a status filter")
+    fields = parse_fields(payload.fields, "snapshot")
+
+    # Snapshots are streamed as NDJSON while the cursors are read: deals with a materialized
+    # snapshot first, then those written before it existed, computed in one aggregation pass
+    async def stream():
+        if not needs_snapshot(fields):
+            async for deal in collection("deal").find(match, snapshot_projection(fields), batch_size=500):
+                yield dumps(pick_fields(deal, fields)) + b"\n"
+            return
+        materialized = collection("deal").find(
+            {**match, "snapshot": {"$type": "object"}}, snapshot_projection(fields), batch_size=500
+        )
+        async for deal in materialized:
+            yield dumps(pick_fields(from_materialized(deal), fields)) + b"\n"
+        legacy = collection("deal").aggregate(
+            snapshot_pipeline({**match, "snapshot": {"$not": {"$type": "object"}}}), batchSize=500
+        )
+        async for doc in legacy:
+            yield dumps(pick_fields(build_snapshot(doc), fields)) + b"\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+# --------- Export endpoint ---------
+@app.get("/api/export/{collection_name}")
+async def export_collection(collection_name: str, format: str = "csv", since: Optional[datetime] = None,
+                            until: Optional[datetime] = None, status: Optional[str] = None,
+                            client: Optional[str] = None, x_export_key: Optional[str] = Header(None)):
+    """Stream a whole collection (optionally filtered) as CSV or NDJSON; needs the export key"""
+    if not authorized(x_export_key):
+        raise HTTPException(status_code=403, detail="A valid X-Export-Key header is required")
+    if collection_name not in EXPORT_MODELS:
+        raise HTTPException(status_code=404, detail=f"Cannot export {collection_name}")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+    if status and "status" not in EXPORT_MODELS[collection_name].model_fields:
+        raise HTTPException(status_code=400, detail=f"{collection_name} has no status")
+    query = export_filter(collection_name, since, until, status, client)
+    return StreamingResponse(
+        export_rows(collection_name, query, format),
+        media_type=FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{collection_name}.{format}"'},
+    )
+
+# --------- Deal events (Server-Sent Events) ---------
+EVENTS_HEARTBEAT_SECONDS = float(os.getenv("EVENTS_HEARTBEAT_SECONDS", "15"))
+
+@app.get("/api/deal/events")
+async def deal_events(deal_id: str):
+    """Stream the deal's status changes as they happen (text/event-stream)"""
+    if not ObjectId.is_valid(deal_id):
+        raise HTTPException(status_code=400, detail="Invalid deal_id")
+
+    async def stream():
+        with event_bus.subscription(deal_id) as queue:
+            yield b"retry: 5000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line: keeps proxies from closing an idle connection
+                    yield b": keepalive\n\n"
+                    continue
+                yield b"event: status\ndata: " + dumps(event) + b"\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,205 @@
+"""
+Maintenance commands for the Deal Admin Hub backend
+
+Usage:
+    python manage.py ensure-indexes
+    python manage.py index-plan
+    python manage.py rebuild-snapshots
+    python manage.py dedupe-deals
+    python manage.py migrate-tokens [--rebuild-indexes]
+"""
+
+import argparse
+import sys
+import time
+
+from pymongo import UpdateOne
+
+import database
+from database import ensure_indexes, INDEXES, MutationBatch
+from snapshots import snapshot_pipeline, materialize
+from tokens import to_stored, from_stored
+
+# Set by main() once the database is known to be configured
+db = None
+
+# The query each endpoint issues, with placeholder values: (endpoint, collection, filter, sort)
+ENDPOINT_QUERIES = [
+    ("GET /api/mou/{token}", "mou", {"sign_token": "0" * 32}, None),
+    ("POST /api/mou/{token}/sign", "mou", {"sign_token": "0" * 32}, None),
+    ("GET /api/invoice/{token}", "invoice", {"view_token": "0" * 32}, None),
+    ("POST /api/invoice/{token}/paid", "invoice", {"view_token": "0" * 32, "status": {"$ne": "paid"}}, None),
+    ("POST /api/invoice/{token}/paid (receipt)", "receipt", {"invoice_token": "0" * 32}, None),
+    ("POST /api/mou (deal upsert)", "deal", {"client_name": "c", "project_name": "p"}, None),
+    ("POST /api/invoice (deal upsert)", "deal", {"client_name": "c", "project_name": "p"}, None),
+    ("GET /api/deal/snapshot (deal)", "deal", {"client_name": "c", "project_name": "p"}, None),
+    ("GET /api/deal/snapshot (mou lookup)", "mou", {"deal_id": "0" * 24}, [("created_at", -1)]),
+    ("GET /api/deal/snapshot (invoice lookup)", "invoice", {"deal_id": "0" * 24}, [("created_at", -1)]),
+    ("GET /api/deal/snapshot (receipt lookup)", "receipt", {"invoice_token": "0" * 32}, None),
+]
+
+def _plan_stages(plan: dict) -> list:
+    """Flatten a winning plan into [(stage, index name)] from the root down"""
+    plan = plan.get("queryPlan", plan)
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    children = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+    for child in children:
+        stages.extend(_plan_stages(child))
+    return stages
+
+def cmd_ensure_indexes(args):
+    for collection_name, names in ensure_indexes().items():
+        print(f"{collection_name}: {', '.join(names)}")
+
+def cmd_index_plan(args):
+    collscans = 0
+    for endpoint, collection_name, filter_dict, sort in ENDPOINT_QUERIES:
+        cursor = db[collection_name].find(filter_dict).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = _plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+        indexes = [name for _, name in stages if name]
+        if any(stage == "COLLSCAN" for stage, _ in stages):
+            collscans += 1
+            verdict = "COLLSCAN"
+        else:
+            verdict = f"IXSCAN {', '.join(indexes)}"
+        print(f"{endpoint:<42} {collection_name:<8} {' > '.join(stage for stage, _ in stages):<28} {verdict}")
+    # Non-zero exit so this can gate CI against COLLSCAN regressions
+    return 1 if collscans else 0
+
+def rebuild_snapshots(match: dict, batch_size: int = 1000) -> int:
+    """Recompute the materialized snapshot of matching deals from the mou/invoice/receipt collections"""
+    requests, rebuilt = [], 0
+    for doc in db.deal.aggregate(snapshot_pipeline(match), batchSize=batch_size, allowDiskUse=True):
+        requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"snapshot": materialize(doc)}}))
+        if len(requests) >= batch_size:
+            rebuilt += db.deal.bulk_write(requests, ordered=False).matched_count
+            requests = []
+    if requests:
+        rebuilt += db.deal.bulk_write(requests, ordered=False).matched_count
+    return rebuilt
+
+def cmd_rebuild_snapshots(args):
+    print(f"Rebuilt {rebuild_snapshots({}, args.batch_size)} deal snapshots")
+
+def cmd_dedupe_deals(args):
+    """Merge deals sharing (client_name, project_name) into the oldest one, then build the unique index"""
+    groups = db.deal.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {"client_name": "$client_name", "project_name": "$project_name"},
+                    "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ], allowDiskUse=True)
+    keepers, removed = [], 0
+    for group in groups:
+        keeper, duplicates = group["ids"][0], group["ids"][1:]
+        batch = MutationBatch(ordered=True)
+        # Re-point documents at the surviving deal before its duplicates disappear
+        for collection_name in ("mou", "invoice", "receipt"):
+            update = {"$set": {"deal_id": str(keeper)}}
+            if collection_name != "receipt":
+                update["$inc"] = {"version": 1}  # the documents' ETags change with them
+            batch.update(collection_name, {"deal_id": {"$in": [str(d) for d in duplicates]}}, update, many=True)
+        batch.delete("deal", {"_id": {"$in": duplicates}}, many=True)
+        result = batch.flush()
+        if not result["ok"]:
+            print(f"Skipped {group['_id']}: {[r['error'] for r in result['results'] if r['error']]}")
+            continue
+        keepers.append(keeper)
+        removed += len(duplicates)
+    if keepers:
+        rebuild_snapshots({"_id": {"$in": keepers}})
+    print(f"Merged {removed} duplicate deals into {len(keepers)}")
+    cmd_ensure_indexes(args)
+
+# Collections and the token field each one stores
+TOKEN_COLLECTIONS = {"mou": "sign_token", "invoice": "view_token", "receipt": "invoice_token"}
+
+def _token_report(samples: dict, convert=lambda value: value) -> dict:
+    """Token index sizes and mean point-lookup latency per collection (samples are stored values)"""
+    rows = {}
+    for collection_name, field in TOKEN_COLLECTIONS.items():
+        index_sizes = db.command("collStats", collection_name).get("indexSizes", {})
+        size = sum(bytes_ for name, bytes_ in index_sizes.items() if name.startswith(field))
+        tokens = samples.get(collection_name, [])
+        started = time.perf_counter()
+        for token in tokens:
+            db[collection_name].find_one({field: convert(token)}, {"_id": 1})
+        latency = (time.perf_counter() - started) / len(tokens) if tokens else 0.0
+        rows[collection_name] = (size, latency)
+    return rows
+
+def _print_token_report(label: str, rows: dict):
+    print(label)
+    for collection_name, (size, latency) in rows.items():
+        print(f"  {collection_name:<8} index {size / 1024:>10.1f} KiB   lookup {latency * 1000:>7.3f} ms")
+
+def cmd_migrate_tokens(args):
+    """Rewrite hex-string tokens as BSON Binary and report index size / lookup latency before and after"""
+    samples = {}
+    for collection_name, field in TOKEN_COLLECTIONS.items():
+        docs = db[collection_name].aggregate([{"$sample": {"size": args.samples}}, {"$project": {field: 1}}])
+        samples[collection_name] = [doc[field] for doc in docs if doc.get(field)]
+    _print_token_report("Before:", _token_report(samples))
+
+    for collection_name, field in TOKEN_COLLECTIONS.items():
+        requests, migrated = [], 0
+        cursor = db[collection_name].find({field: {"$type": "string"}}, {field: 1}, batch_size=args.batch_size)
+        for doc in cursor:
+            stored = to_stored(doc[field])
+            if stored != doc[field]:
+                # Guard on the old value so a concurrent write is never clobbered
+                requests.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: stored}}))
+            if len(requests) >= args.batch_size:
+                migrated += db[collection_name].bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            migrated += db[collection_name].bulk_write(requests, ordered=False).modified_count
+        print(f"{collection_name}: migrated {migrated} tokens")
+
+        if args.rebuild_indexes:
+            # WiredTiger does not give back index pages in place; rebuilding shows the real size
+            for index in INDEXES.get(collection_name, []):
+                if index.document["key"].get(field) is not None:
+                    db[collection_name].drop_index(index.document["name"])
+                    db[collection_name].create_indexes([index])
+
+    _print_token_report("After:", _token_report(samples, lambda value: to_stored(from_stored(value))))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("ensure-indexes", help="create all indexes declared in database.INDEXES")
+    cmd.set_defaults(func=cmd_ensure_indexes)
+
+    cmd = commands.add_parser("index-plan", help="print the winning plan of every endpoint query; exit 1 on COLLSCAN")
+    cmd.set_defaults(func=cmd_index_plan)
+
+    cmd = commands.add_parser("rebuild-snapshots", help="recompute the materialized snapshot on every deal")
+    cmd.add_argument("--batch-size", type=int, default=1000)
+    cmd.set_defaults(func=cmd_rebuild_snapshots)
+
+    cmd = commands.add_parser("dedupe-deals", help="merge duplicate (client_name, project_name) deals")
+    cmd.set_defaults(func=cmd_dedupe_deals)
+
+    cmd = commands.add_parser("migrate-tokens", help="store client tokens as BSON Binary instead of hex strings")
+    cmd.add_argument("--batch-size", type=int, default=1000)
+    cmd.add_argument("--samples", type=int, default=500, help="tokens per collection used to time lookups")
+    cmd.add_argument("--rebuild-indexes", action="store_true", help="rebuild token indexes after migrating")
+    cmd.set_defaults(func=cmd_migrate_tokens)
+
+    args = parser.parse_args()
+    global db
+    try:
+        db = database.get_db()
+    except Exception as e:
+        sys.exit(str(e))
+    try:
+        sys.exit(args.func(args) or 0)
+    finally:
+        database.close()
+
+if __name__ == "__main__":
+    main()
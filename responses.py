@@ -0,0 +1,131 @@
+"""
+JSON Responses
+
+orjson-backed response class used as the application's default. It encodes the
+values MongoDB documents carry (ObjectId, datetime, Decimal128) directly, so
+endpoints can return fetched documents as they are.
+
+FastAPI still runs jsonable_encoder over plain dicts returned from an endpoint;
+hot endpoints return ORJSONResponse(doc) themselves to skip that pass.
+"""
+
+import struct
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import orjson
+from bson import ObjectId, Decimal128
+from bson.binary import Binary
+from fastapi.responses import ORJSONResponse as _ORJSONResponse
+
+def _default(value):
+    """orjson fallback for types it does not know"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if isinstance(value, Decimal):
+        # Same number mapping as FastAPI's jsonable_encoder
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    """Serialize `content` to JSON bytes (datetimes as ISO 8601, ObjectIds as hex strings)"""
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+class ORJSONResponse(_ORJSONResponse):
+    """FastAPI's ORJSONResponse, extended to BSON types"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+# --------- BSON to JSON transcoding ---------
+# Opt-in path for documents fetched as RawBSONDocument: the BSON bytes are walked once
+# and JSON is written as they are read, without building the Python dicts and lists of
+# the decoded document. The output matches dumps() on the decoded document.
+# Being pure Python it trades CPU for memory: peak allocation drops most on documents
+# with many small values, but each value costs more than in bson's C decoder
+# (see `python benchmark.py raw-bson`).
+
+_INT32 = struct.Struct("<i")
+_INT64 = struct.Struct("<q")
+_DOUBLE = struct.Struct("<d")
+_EPOCH = datetime(1970, 1, 1)
+
+def _write_string(out: bytearray, raw: bytes):
+    out += orjson.dumps(raw.decode())
+
+def _write_document(data: bytes, pos: int, out: bytearray, is_array: bool, binary, exclude=()) -> int:
+    """Write the document/array starting at `pos`, leaving out `exclude` keys; returns the position after it"""
+    end = pos + _INT32.unpack_from(data, pos)[0] - 1
+    pos += 4
+    out += b"[" if is_array else b"{"
+    first = True
+    while pos < end:
+        kind = data[pos]
+        name_end = data.index(b"\x00", pos + 1)
+        if exclude and data[pos + 1:name_end].decode() in exclude:
+            pos = _write_value(data, name_end + 1, kind, bytearray(), binary)
+            continue
+        if not first:
+            out += b","
+        first = False
+        if not is_array:
+            _write_string(out, data[pos + 1:name_end])
+            out += b":"
+        pos = _write_value(data, name_end + 1, kind, out, binary)
+    out += b"]" if is_array else b"}"
+    return end + 1
+
+def _write_value(data: bytes, pos: int, kind: int, out: bytearray, binary) -> int:
+    """Write one BSON value of type `kind` starting at `pos`; returns the position after it"""
+    if kind == 0x02:  # string
+        length = _INT32.unpack_from(data, pos)[0]
+        _write_string(out, data[pos + 4:pos + 3 + length])
+        return pos + 4 + length
+    if kind == 0x03 or kind == 0x04:  # document, array
+        return _write_document(data, pos, out, kind == 0x04, binary)
+    if kind == 0x07:  # ObjectId
+        out += b'"' + data[pos:pos + 12].hex().encode() + b'"'
+        return pos + 12
+    if kind == 0x01:  # double
+        value = _DOUBLE.unpack_from(data, pos)[0]
+        out += orjson.dumps(value)
+        return pos + 8
+    if kind == 0x10:  # int32
+        out += str(_INT32.unpack_from(data, pos)[0]).encode()
+        return pos + 4
+    if kind == 0x12:  # int64
+        out += str(_INT64.unpack_from(data, pos)[0]).encode()
+        return pos + 8
+    if kind == 0x08:  # bool
+        out += b"true" if data[pos] else b"false"
+        return pos + 1
+    if kind == 0x0A:  # null
+        out += b"null"
+        return pos
+    if kind == 0x09:  # UTC datetime, naive like the decoded documents
+        milliseconds = _INT64.unpack_from(data, pos)[0]
+        out += orjson.dumps(_EPOCH + timedelta(milliseconds=milliseconds))
+        return pos + 8
+    if kind == 0x13:  # Decimal128
+        out += orjson.dumps(Decimal128.from_bid(data[pos:pos + 16]), default=_default)
+        return pos + 16
+    if kind == 0x05 and binary is not None:  # binary
+        length = _INT32.unpack_from(data, pos)[0]
+        value, subtype = data[pos + 5:pos + 5 + length], data[pos + 4]
+        # Decoded documents carry subtype 0 as plain bytes
+        value = Binary(value, subtype) if subtype else value
+        out += orjson.dumps(binary(value), default=_default)
+        return pos + 5 + length
+    raise TypeError(f"BSON type 0x{kind:02x} is not JSON serializable")
+
+def bson_to_json(data: bytes, binary=None, exclude=()) -> bytes:
+    """JSON bytes for a raw BSON document without its top-level `exclude` keys
+
+    `binary` maps Binary values to JSON-encodable ones. Raises TypeError for BSON
+    types the API never stores (timestamps, regexes, code, ...).
+    """
+    out = bytearray()
+    _write_document(data, 0, out, False, binary, exclude)
+    return bytes(out)
@@ -68,8 +68,8 @@ def add_comment_to_post(post_id: str, author_id: str, comment_text: str):
     }
     
     # Add comment to post's comments array
-    from database import db
-    result = db.posts.update_one(
+    from database import get_db
+    result = get_db().posts.update_one(
         {"_id": ObjectId(post_id)},
         {"$push": {"comments": comment}}
     )
@@ -264,7 +264,7 @@ def track_user_activity(user_id: str, action: str, resource_type: str, resource_
         "session_id": None,
         "timestamp": datetime.utcnow()
     }
-    return create_document("user_activities", activity_data)
+    return create_document("user_activities", activity_data, coalesce=True)
 
 def track_page_view(page_path: str, user_id: str = None, session_id: str = None):
     """Track page views for analytics"""
@@ -284,7 +284,7 @@ def track_page_view(page_path: str, user_id: str = None, session_id: str = None)
         },
         "timestamp": datetime.utcnow()
     }
-    return create_document("page_views", pageview_data)
+    return create_document("page_views", pageview_data, coalesce=True)
 
 # =============================================================================
 # NOTIFICATION SCHEMA
@@ -17,6 +17,7 @@ class Deal(BaseModel):
     my_name: str = Field(default="Dimiro Networks / 59 Shift")
     my_contact: Optional[str] = None
     status: str = Field(default="active", description="active|archived")
+    snapshot: Optional[Dict[str, Any]] = Field(default=None, description="materialized deal status, see snapshots.py")
 
 class Mou(BaseModel):
     deal_id: str
@@ -29,6 +30,7 @@ class Mou(BaseModel):
     signed_at: Optional[datetime] = None
     client_signature_name: Optional[str] = None
     client_signature_title: Optional[str] = None
+    version: int = Field(default=1, description="incremented on every write; backs the ETag")
 
 class Invoice(BaseModel):
     deal_id: str
@@ -47,6 +49,7 @@ class Invoice(BaseModel):
     paid_at: Optional[str] = None
     payment_method: Optional[str] = None
     amount_received: Optional[float] = None
+    version: int = Field(default=1, description="incremented on every write; backs the ETag")
 
 class Receipt(BaseModel):
     invoice_token: str
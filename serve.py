@@ -0,0 +1,116 @@
+"""
+Server launcher for the Deal Admin Hub backend
+
+Usage:
+    python serve.py dev                      # one uvicorn process, restarts on code changes
+    python serve.py prod                     # gunicorn + uvicorn workers, one per CPU
+    python serve.py prod --workers 4 --preload
+
+Production mode:
+- WEB_CONCURRENCY (or --workers) overrides the worker count, which defaults to the
+  number of CPUs this process may run on
+- uvloop and httptools are used when installed, asyncio and h11 otherwise
+- --preload imports the app once in the master before forking; workers start
+  faster and share memory, but SIGHUP then restarts workers without reloading code
+- SIGHUP starts a fresh set of workers and retires the old ones once they have
+  finished their in-flight requests (graceful_timeout), so deploys drop no requests
+- every worker heartbeats the master from its event loop; a worker whose loop is
+  blocked for longer than --timeout is killed and replaced. GET /healthz answers
+  from whichever worker takes the connection, for load balancer checks
+"""
+
+import argparse
+import importlib.util
+import os
+
+APP = "main:app"
+
+LOOP = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+try:
+    from uvicorn.workers import UvicornWorker
+except ImportError:  # gunicorn is only needed in production mode
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+    class Worker(UvicornWorker):
+        """Uvicorn worker for gunicorn, on uvloop/httptools when installed"""
+        CONFIG_KWARGS = {"loop": LOOP, "http": HTTP, "lifespan": "on"}
+
+def default_workers() -> int:
+    """WEB_CONCURRENCY, else the CPUs available to this process (respects container cpusets)"""
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.environ["WEB_CONCURRENCY"])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def run_dev(args):
+    import uvicorn
+
+    uvicorn.run(APP, host=args.host, port=args.port, reload=True, log_level=args.log_level)
+
+def run_prod(args):
+    if UvicornWorker is None:
+        raise SystemExit("Production mode needs gunicorn: pip install -r requirements.txt")
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.util import import_app
+
+    class Application(BaseApplication):
+        def __init__(self, options: dict):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            return import_app(APP)
+
+    def when_ready(server):
+        server.log.info("Serving %s with %d workers (loop=%s, http=%s, preload=%s)",
+                        APP, args.workers, LOOP, HTTP, args.preload)
+
+    def worker_abort(worker):
+        worker.log.warning("Worker %s missed its heartbeat for %ss and is being replaced", worker.pid, args.timeout)
+
+    Application({
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "worker_class": "serve.Worker",
+        "preload_app": args.preload,
+        "timeout": args.timeout,
+        "graceful_timeout": args.graceful_timeout,
+        "keepalive": args.keepalive,
+        "loglevel": args.log_level,
+        "accesslog": "-" if args.access_log else None,
+        "when_ready": when_ready,
+        "worker_abort": worker_abort,
+    }).run()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("mode", choices=("dev", "prod"))
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    parser.add_argument("--workers", type=int, default=default_workers())
+    parser.add_argument("--preload", action="store_true", default=os.getenv("PRELOAD") in ("1", "true", "True"))
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WORKER_TIMEOUT", "30")),
+                        help="seconds a worker may go without a heartbeat before it is replaced")
+    parser.add_argument("--graceful-timeout", type=int, default=int(os.getenv("GRACEFUL_TIMEOUT", "30")),
+                        help="seconds old workers get to finish requests on SIGHUP/SIGTERM")
+    parser.add_argument("--keepalive", type=int, default=5)
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    if args.mode == "dev":
+        run_dev(args)
+    else:
+        run_prod(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Deal Snapshot Helpers
+
+A snapshot summarises where a deal stands: the latest MOU and invoice (status and
+client link), whether the latest invoice has a receipt, and a next-step hint.
+
+The snapshot is materialized on the deal itself under `snapshot` and kept current by
+the lifecycle endpoints with snapshot_update(), so reading it is a single find_one.
+snapshot_pipeline() recomputes it from the source collections in one aggregation; it
+backs the rebuild command and deals written before the field existed.
+"""
+
+from tokens import from_stored
+
+def _latest(collection_name: str, token_field: str) -> dict:
+    """$lookup of the newest document in `collection_name` for the current deal"""
+    return {"$lookup": {
+        "from": collection_name,
+        "let": {"deal_id": "$deal_id"},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$deal_id", "$$deal_id"]}}},
+            {"$sort": {"created_at": -1}},
+            {"$limit": 1},
+            {"$project": {"_id": 0, "status": 1, token_field: 1}},
+        ],
+        "as": collection_name,
+    }}
+
+def snapshot_pipeline(match: dict, limit: int = None) -> list:
+    """Aggregation over `deal` yielding one document per matched deal with its latest mou/invoice/receipt"""
+    pipeline = [{"$match": match}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    pipeline += [
+        # mou/invoice reference deals by the string form of the deal _id
+        {"$project": {"client_name": 1, "project_name": 1, "deal_id": {"$toString": "$_id"}}},
+        _latest("mou", "sign_token"),
+        _latest("invoice", "view_token"),
+        {"$addFields": {
+            "mou": {"$arrayElemAt": ["$mou", 0]},
+            "invoice": {"$arrayElemAt": ["$invoice", 0]},
+        }},
+        {"$lookup": {
+            "from": "receipt",
+            # "" never matches a real token, so a deal without an invoice finds no receipt
+            "let": {"token": {"$ifNull": ["$invoice.view_token", ""]}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$invoice_token", "$$token"]}}},
+                {"$limit": 1},
+                {"$project": {"_id": 1}},
+            ],
+            "as": "receipt",
+        }},
+    ]
+    return pipeline
+
+def document_status(doc: dict, token_field: str, link_prefix: str) -> dict:
+    """{"status", "link"} for a mou/invoice document (or None)"""
+    if not doc:
+        return {"status": "Draft", "link": None}
+    status = doc.get("status", "draft").capitalize()
+    token = from_stored(doc.get(token_field))
+    link = f"{link_prefix}{token}" if token else None
+    return {"status": status, "link": link}
+
+def next_step(mou_status: str, invoice_status: str, receipt_available: bool) -> str:
+    """Hint for what the user should do next"""
+    ms = mou_status.lower()
+    ins = invoice_status.lower()
+    if ms == "draft":
+        return "Next: Generate sign link and send to client."
+    elif ms == "signed" and ins == "draft":
+        return "Next: Generate invoice and send."
+    elif ins == "paid" and not receipt_available:
+        return "Next: Generate receipt and send."
+    return ""
+
+def materialize(doc: dict) -> dict:
+    """The `snapshot` sub-document for one snapshot_pipeline() result"""
+    mou = document_status(doc.get("mou"), "sign_token", "/sign/")
+    invoice = document_status(doc.get("invoice"), "view_token", "/invoice/")
+    receipt_available = bool(doc.get("receipt"))
+    return {
+        "mou": mou,
+        "invoice": invoice,
+        "receipt_available": receipt_available,
+        "next_step": next_step(mou["status"], invoice["status"], receipt_available),
+    }
+
+def build_snapshot(doc: dict) -> dict:
+    """API response for one snapshot_pipeline() result"""
+    return {"client_name": doc.get("client_name"), "project_name": doc.get("project_name"), **materialize(doc)}
+
+def from_materialized(deal: dict) -> dict:
+    """API response for a deal carrying a materialized `snapshot`"""
+    return {"client_name": deal.get("client_name"), "project_name": deal.get("project_name"), **deal["snapshot"]}
+
+def initial_snapshot(mou: dict = None, invoice: dict = None) -> dict:
+    """`snapshot` for a brand-new deal created together with its first MOU or invoice"""
+    return materialize({"mou": mou, "invoice": invoice})
+
+# Server-side twin of next_step(), evaluated inside the same update that changes the snapshot
+_NEXT_STEP = {"$switch": {
+    "branches": [
+        {"case": {"$eq": ["$snapshot.mou.status", "Draft"]},
+         "then": "Next: Generate sign link and send to client."},
+        {"case": {"$and": [{"$eq": ["$snapshot.mou.status", "Signed"]},
+                           {"$eq": ["$snapshot.invoice.status", "Draft"]}]},
+         "then": "Next: Generate invoice and send."},
+        {"case": {"$and": [{"$eq": ["$snapshot.invoice.status", "Paid"]},
+                           {"$not": ["$snapshot.receipt_available"]}]},
+         "then": "Next: Generate receipt and send."},
+    ],
+    "default": "",
+}}
+
+def snapshot_update(fields: dict) -> list:
+    """Pipeline update setting snapshot.<path> values and recomputing next_step atomically"""
+    return [
+        {"$set": {f"snapshot.{path}": {"$literal": value} for path, value in fields.items()}},
+        {"$set": {"snapshot.next_step": _NEXT_STEP}},
+    ]
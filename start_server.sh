@@ -2,9 +2,9 @@
 echo "Starting FastAPI backend server..."
 
 # Find and kill MainThread processes
-PIDS=$(ps | grep uvicorn | grep -v grep | awk '{print $1}')
+PIDS=$(ps | grep -E "uvicorn|gunicorn|serve.py" | grep -v grep | awk '{print $1}')
 if [ ! -z "$PIDS" ]; then
-  echo "Killing uvicorn processes: $PIDS"
+  echo "Killing server processes: $PIDS"
   for pid in $PIDS; do
     kill $pid 2>/dev/null || true
   done
@@ -14,6 +14,7 @@ fi
 mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
-echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
+# SERVE_MODE=prod runs one worker per CPU under gunicorn; dev (default) reloads on code changes
+echo "Starting FastAPI server (${SERVE_MODE:-dev})..."
+nohup python serve.py "${SERVE_MODE:-dev}" --host 0.0.0.0 --port 8000 > logs/server.log 2>&1 
 echo "Server started in background"
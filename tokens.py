@@ -0,0 +1,261 @@
+"""
+Client Link Tokens
+
+MOUs and invoices are reached by the client through an unguessable token
+(mou.sign_token, invoice.view_token). This module holds the helpers that let the
+API reject unknown tokens without a database lookup.
+
+Two token formats are accepted:
+- legacy: uuid4().hex, resolved through the token index and pre-filtered by TokenFilter
+- signed (when TOKEN_SECRET is set): "<kind code><document _id hex><HMAC-SHA256 prefix>",
+  verified in memory and resolved with an _id lookup
+
+The API always speaks hex strings. In MongoDB, tokens are stored as BSON Binary
+(TOKEN_STORAGE=binary, the default): uuid tokens as 16-byte UUID-subtype values and
+signed tokens as 29 raw bytes, several times smaller in the token indexes than the
+hex strings. store_tokens()/load_tokens() convert documents on the way in and out;
+lookups match both forms so documents not yet migrated keep resolving.
+"""
+
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from bson import ObjectId
+from bson.binary import Binary, UUID_SUBTYPE
+
+from cache import BloomFilter, SingleFlight
+from database import iter_documents_async
+
+logger = logging.getLogger(__name__)
+
+# Token field per collection
+TOKEN_FIELDS = {"mou": "sign_token", "invoice": "view_token"}
+
+# Every document field holding a client token (receipts reference their invoice's token)
+STORED_TOKEN_FIELDS = ("sign_token", "view_token", "invoice_token")
+
+TOKEN_STORAGE = os.getenv("TOKEN_STORAGE", "binary")
+
+# --------- Signed tokens ---------
+
+TOKEN_SECRET = os.getenv("TOKEN_SECRET", "").encode()
+
+_KIND_CODES = {"mou": "m", "invoice": "i"}
+_MAC_LENGTH = 32  # hex characters, i.e. 128 bits of HMAC-SHA256
+_SIGNED_LENGTH = 1 + 24 + _MAC_LENGTH
+
+def _mac(code: str, oid_hex: str) -> str:
+    return hmac.new(TOKEN_SECRET, f"{code}{oid_hex}".encode(), hashlib.sha256).hexdigest()[:_MAC_LENGTH]
+
+def is_signed(token: str) -> bool:
+    """Whether `token` has the signed format (it may still fail verification)"""
+    return len(token) == _SIGNED_LENGTH and token[0] in _KIND_CODES.values()
+
+def sign(kind: str, document_id: ObjectId) -> str:
+    code = _KIND_CODES[kind]
+    return f"{code}{document_id}{_mac(code, str(document_id))}"
+
+def verify(kind: str, token: str):
+    """The document id a signed token was issued for, or None if it is not a valid `kind` token"""
+    if not TOKEN_SECRET or not is_signed(token) or token[0] != _KIND_CODES[kind]:
+        return None
+    oid_hex, mac = token[1:25], token[25:]
+    if not ObjectId.is_valid(oid_hex):
+        return None
+    # compare_digest only takes ASCII str; the MAC part may be anything the client sent
+    if not hmac.compare_digest(mac.encode(), _mac(token[0], oid_hex).encode()):
+        return None
+    return ObjectId(oid_hex)
+
+def issue_token(kind: str) -> tuple:
+    """New client token for a `kind` document; returns (token, pre-allocated _id or None)
+
+    With TOKEN_SECRET set, the document id is allocated here and embedded in a
+    signed token, so the caller must insert the document with that _id.
+    """
+    if TOKEN_SECRET:
+        document_id = ObjectId()
+        return sign(kind, document_id), document_id
+    return uuid4().hex, None
+
+class TokenFilter:
+    """Bloom filters over every issued token, one per collection
+
+    Built from MongoDB at startup, extended by the create endpoints, and
+    refreshed periodically so tokens issued by other server processes are
+    picked up. Until the first build finishes every token is let through.
+
+    A token issued by another process (or inserted directly) is missing until the
+    next refresh, so a miss is only final after a refresh that started after it:
+    the miss waits for one, shared by concurrent misses and run at most once per
+    `miss_refresh_seconds`, and checks again. If that refresh fails the token is
+    let through.
+    """
+
+    def __init__(self, capacity: int, error_rate: float, refresh_seconds: float, enabled: bool = True,
+                 miss_refresh_seconds: float = 1):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self.miss_refresh_seconds = miss_refresh_seconds
+        self.enabled = enabled
+        self.ready = False
+        self.rejected = 0
+        self.late_hits = 0
+        self.filters = {kind: BloomFilter(capacity, error_rate) for kind in TOKEN_FIELDS}
+        self._synced_at = None
+        self._refreshed_from = 0.0  # monotonic start of the last successful build/refresh
+        self._refreshes = SingleFlight()
+
+    def add(self, kind: str, token: str):
+        self.filters[kind].add(token)
+
+    async def might_exist(self, kind: str, token: str) -> bool:
+        """False only if `token` was certainly never issued"""
+        if not (self.enabled and self.ready):
+            return True
+        if token in self.filters[kind]:
+            return True
+        arrived = time.monotonic()
+        while self._refreshed_from < arrived:
+            try:
+                await self._refreshes.do("refresh", self._refresh_after_miss)
+            except Exception as e:
+                logger.warning("Token filter refresh failed, letting %s token through: %s", kind, e)
+                return True
+        if token in self.filters[kind]:
+            self.late_hits += 1
+            return True
+        self.rejected += 1
+        return False
+
+    async def _refresh_after_miss(self):
+        await asyncio.sleep(self._refreshed_from + self.miss_refresh_seconds - time.monotonic())
+        await self.refresh()
+
+    async def _load(self, kind: str, filter_dict: dict = None):
+        field = TOKEN_FIELDS[kind]
+        async for doc in iter_documents_async(kind, filter_dict, projection={field: 1, "_id": 0}, batch_size=10000):
+            token = from_stored(doc.get(field))
+            # Signed tokens verify themselves and need no filter entry
+            if token and not is_signed(token):
+                self.filters[kind].add(token)
+
+    async def build(self, database):
+        """Size each filter for the current collection (with 2x headroom) and load every token"""
+        started = datetime.now(timezone.utc)
+        refreshed_from = time.monotonic()
+        for kind in TOKEN_FIELDS:
+            existing = await database[kind].estimated_document_count()
+            # Replace before scanning so tokens added concurrently land in the new filter
+            self.filters[kind] = BloomFilter(max(self.capacity, existing * 2), self.error_rate)
+            await self._load(kind)
+        self._synced_at = started
+        self._refreshed_from = refreshed_from
+        self.ready = True
+
+    async def refresh(self):
+        """Load tokens from documents created since the last sync (with a minute of overlap for clock skew)"""
+        started = datetime.now(timezone.utc)
+        refreshed_from = time.monotonic()
+        since = ObjectId.from_datetime(self._synced_at - timedelta(minutes=1))
+        for kind in TOKEN_FIELDS:
+            await self._load(kind, {"_id": {"$gte": since}})
+        self._synced_at = started
+        self._refreshed_from = max(self._refreshed_from, refreshed_from)
+
+    async def run(self, database):
+        """Background task: build once, then refresh every `refresh_seconds`"""
+        if not self.enabled or database is None:
+            return
+        try:
+            await self.build(database)
+        except Exception as e:
+            logger.error("Token filter build failed, unknown tokens will not be pre-filtered: %s", e)
+            return
+        while self.refresh_seconds > 0:
+            await asyncio.sleep(self.refresh_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Token filter refresh failed: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "rejected": self.rejected,
+            "late_hits": self.late_hits,
+            "filters": {kind: bloom.stats() for kind, bloom in self.filters.items()},
+        }
+
+token_filter = TokenFilter(
+    capacity=int(os.getenv("TOKEN_FILTER_CAPACITY", "1000000")),
+    error_rate=float(os.getenv("TOKEN_FILTER_ERROR_RATE", "0.001")),
+    refresh_seconds=float(os.getenv("TOKEN_FILTER_REFRESH_SECONDS", "5")),
+    enabled=os.getenv("TOKEN_FILTER_ENABLED", "1") not in ("0", "false", "False"),
+    miss_refresh_seconds=float(os.getenv("TOKEN_FILTER_MISS_REFRESH_SECONDS", "1")),
+)
+
+# --------- Storage format ---------
+
+def to_stored(token: str):
+    """BSON value for a hex token (unchanged with TOKEN_STORAGE=string or for unknown formats)"""
+    if TOKEN_STORAGE != "binary" or not isinstance(token, str):
+        return token
+    try:
+        if is_signed(token):
+            return Binary(token[0].encode() + bytes.fromhex(token[1:]))
+        if len(token) == 32:
+            return Binary(bytes.fromhex(token), UUID_SUBTYPE)
+    except ValueError:
+        pass
+    return token
+
+def from_stored(value) -> str:
+    """Hex token for a stored value (either form)"""
+    if isinstance(value, Binary) and value.subtype == UUID_SUBTYPE:
+        return value.hex()
+    # Signed tokens are subtype 0, which pymongo decodes to plain bytes
+    if isinstance(value, bytes):
+        return chr(value[0]) + value[1:].hex()
+    return value
+
+def stored_match(token: str):
+    """Query value matching `token` whether its document is stored in binary or string form"""
+    stored = to_stored(token)
+    return token if stored == token else {"$in": [stored, token]}
+
+def store_tokens(data) -> dict:
+    """Document dict (from a model or dict) with its token fields in storage form"""
+    doc = data.model_dump() if hasattr(data, "model_dump") else dict(data)
+    for field in STORED_TOKEN_FIELDS:
+        if field in doc:
+            doc[field] = to_stored(doc[field])
+    return doc
+
+def load_tokens(doc: dict) -> dict:
+    """Convert a fetched document's token fields back to hex strings, in place"""
+    for field in STORED_TOKEN_FIELDS:
+        if field in doc:
+            doc[field] = from_stored(doc[field])
+    return doc
+
+async def token_query(kind: str, token: str):
+    """MongoDB filter resolving a client token, or None if the token cannot exist
+
+    Signed tokens become a primary-key lookup; legacy uuid tokens go through the
+    token index after the Bloom filter has had a chance to reject them.
+    """
+    if is_signed(token):
+        document_id = verify(kind, token)
+        return {"_id": document_id} if document_id else None
+    if not await token_filter.might_exist(kind, token):
+        return None
+    return {TOKEN_FIELDS[kind]: stored_match(token)}